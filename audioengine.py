@@ -0,0 +1,311 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from playback import JitterHistogram
+from smf import META, META_TEMPO, TempoMap
+from synth import (CHAN_DRUMS, DEFAULT_TIMBRE, DRUMS, MASTER_GAIN, SAMPLE_RATE, TABLE_SIZE,
+                   TIMBRES, DrumCache, MappedWav, adsr, audible_partials, note_frequency, partial_table,
+                   release_ramp, to_pcm16)
+
+# Streaming audio: a callback-style engine that turns a (possibly endless) stream of
+# time-ordered MidiEvents into fixed-size blocks of samples. Event ticks are converted to
+# sample positions with a tempo map that follows the stream's tempo changes, and every event
+# takes effect on its exact sample: a block is mixed in runs between events.
+#
+# Voices live in a fixed pool of preallocated arrays (one slot per voice), so memory stays
+# constant however long the stream runs. All active voices of a run are mixed in one set of
+# array operations (voices x frames): pitched voices read their wavetable from a shared table
+# bank (one row per timbre and number of audible partials, see synth.audible_partials) with
+# the same envelope as synth.py; drum voices read their one-shot from a shared buffer. When
+# the pool is full, a note-on steals the oldest released voice, or else the oldest voice.
+
+BLOCK = 512    # frames per block
+VOICES = 64    # voice pool size
+
+# Block compute times in nanoseconds, bucketed in microseconds
+class BlockTimes(JitterHistogram):
+    EDGES_US = (0, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+class AudioEngine:
+    def __init__(self, events, ticks_per_beat, sample_rate=SAMPLE_RATE, block=BLOCK,
+                 voices=VOICES, tempo_map=None, drums=None):
+        self.events = iter(events)
+        self.sample_rate = sample_rate
+        self.drums = DrumCache(sample_rate) if drums is None else drums
+        self.block = block
+        self.follow_tempo = tempo_map is None
+        self.tempo_map = TempoMap(ticks_per_beat) if tempo_map is None else tempo_map
+        self.programs = {}
+        self.sample = 0            # position of the next block
+        self.stolen = 0
+        self.block_times = BlockTimes()
+        self.out = np.zeros(block, dtype=np.float32)
+        self.frames = np.arange(block, dtype=np.int64)
+        self._build_tables()
+        # Voice pool
+        self.active = np.zeros(voices, dtype=bool)
+        self.drum = np.zeros(voices, dtype=bool)
+        self.released = np.zeros(voices, dtype=bool)
+        self.channel = np.zeros(voices, dtype=np.int64)
+        self.pitch = np.zeros(voices, dtype=np.int64)
+        self.age = np.zeros(voices, dtype=np.int64)        # samples since note-on
+        self.release_at = np.zeros(voices, dtype=np.int64)  # age at note-off
+        self.release_level = np.zeros(voices, dtype=np.float32)
+        self.row = np.zeros(voices, dtype=np.int64)         # table bank row / drum index
+        self.phase = np.zeros(voices, dtype=np.float64)     # cycles
+        self.step = np.zeros(voices, dtype=np.float64)      # cycles per sample
+        self.detune = np.zeros(voices, dtype=np.float64)
+        self.detune_phase = np.zeros(voices, dtype=np.float64)  # of the detuned oscillator
+        self.gain = np.zeros(voices, dtype=np.float32)
+        self.attack = np.ones(voices, dtype=np.float32)
+        self.decay = np.ones(voices, dtype=np.float32)
+        self.sustain = np.zeros(voices, dtype=np.float32)
+        self.release = np.ones(voices, dtype=np.float32)
+        self.drive = np.zeros(voices, dtype=np.float32)
+        self._next = None
+        self._fetch()
+
+    # Table bank: a row per (timbre, audible partial count)
+    def _build_tables(self):
+        timbres = [(program, timbre) for program, timbre in TIMBRES.items()]
+        timbres.append((None, DEFAULT_TIMBRE))
+        rows, self.table_rows = [], {}
+        for program, timbre in timbres:
+            for count in range(1, len(timbre["harmonics"]) + 1):
+                self.table_rows[program, count] = len(rows)
+                rows.append(partial_table(timbre, count))
+        self.tables = np.stack(rows)
+        self.drum_index = {}
+        self.drum_length = np.zeros(0, dtype=np.int64)
+        self.drum_offset = np.zeros(0, dtype=np.int64)
+        self.drum_data = np.zeros(0, dtype=np.float32)
+        for note in DRUMS:
+            self._drum_row(note)
+
+    # Drum one-shots at full velocity, back to back in one buffer, each followed by a zero
+    # sample. Notes are added on first use (at most 128, so memory stays bounded).
+    def _drum_row(self, note):
+        row = self.drum_index.get(note)
+        if row is None:
+            shot, _ = self.drums.get(note, 127)
+            row = self.drum_index[note] = len(self.drum_length)
+            self.drum_offset = np.append(self.drum_offset, len(self.drum_data))
+            self.drum_length = np.append(self.drum_length, len(shot))
+            self.drum_data = np.concatenate([self.drum_data, shot, np.zeros(1, dtype=np.float32)])
+        return row
+
+    # Sample position of the next event (None when the stream has ended)
+    def _fetch(self):
+        self._next = next(self.events, None)
+        if self._next is not None:
+            event = self._next
+            if self.follow_tempo and event.status == META and event.data1 == META_TEMPO:
+                self.tempo_map.append(event.tick, int.from_bytes(event.data2, 'big'))
+                self.tempo_map.trim(event.tick)   # the stream never goes back
+            us = self.tempo_map.tick_to_us(event.tick)
+            self._next_sample = int(round(us * self.sample_rate / 1e6))
+
+    # True once the stream has ended and every voice has died away
+    def finished(self):
+        return self._next is None and not self.active.any()
+
+    # Fill `out` (default: the engine's own block buffer) with the next block of samples.
+    # Returns the buffer; it is overwritten by the next call.
+    def process(self, out=None):
+        start_ns = time.perf_counter_ns()
+        out = self.out if out is None else out
+        out[:] = 0
+        n = len(out)
+        pos = 0
+        while pos < n:
+            end = n
+            if self._next is not None:
+                end = min(n, max(self._next_sample - self.sample, pos))
+            if end > pos:
+                self._mix(out, pos, end)
+                pos = end
+            if pos < n:
+                self._apply(self._next)
+                self._fetch()
+        self.sample += n
+        self.block_times.record(time.perf_counter_ns() - start_ns)
+        return out
+
+    # Blocks until the stream ends and the voices die away, or `limit` blocks
+    def blocks(self, limit=None):
+        count = 0
+        while not self.finished() and (limit is None or count < limit):
+            yield self.process()
+            count += 1
+
+    def _apply(self, event):
+        status = event.status
+        if status >= 0xF0:
+            return
+        kind, channel = status & 0xF0, status & 0x0F
+        if kind == 0xC0:
+            self.programs[channel] = event.data1
+        elif kind == 0x90 and event.data2 > 0:
+            self._note_on(channel, event.data1, event.data2)
+        elif (kind == 0x80 or kind == 0x90) and channel != CHAN_DRUMS:
+            self._note_off(channel, event.data1)
+
+    def _note_on(self, channel, pitch, velocity):
+        v = self._allocate()
+        self.active[v] = True
+        self.released[v] = False
+        self.channel[v] = channel
+        self.pitch[v] = pitch
+        self.age[v] = 0
+        if channel == CHAN_DRUMS:
+            self.drum[v] = True
+            self.row[v] = self._drum_row(pitch)
+            self.gain[v] = velocity / 127
+            return
+        program = self.programs.get(channel, 0)
+        timbre = TIMBRES.get(program)
+        if timbre is None:
+            program, timbre = None, DEFAULT_TIMBRE
+        freq = float(note_frequency(pitch))
+        self.drum[v] = False
+        self.row[v] = self.table_rows[program, audible_partials(timbre, freq, self.sample_rate)]
+        self.phase[v] = 0.0
+        self.detune_phase[v] = 0.0
+        self.step[v] = freq / self.sample_rate
+        self.detune[v] = timbre["detune"]
+        self.gain[v] = MASTER_GAIN * timbre["gain"] * velocity / 127
+        self.attack[v] = timbre["attack"]
+        self.decay[v] = timbre["decay"]
+        self.sustain[v] = timbre["sustain"]
+        self.release[v] = timbre["release"]
+        self.drive[v] = timbre["drive"]
+
+    # Release the oldest held voice playing this note
+    def _note_off(self, channel, pitch):
+        held = np.flatnonzero(self.active & ~self.drum & ~self.released
+                              & (self.channel == channel) & (self.pitch == pitch))
+        if not len(held):
+            return
+        v = held[np.argmax(self.age[held])]
+        self.released[v] = True
+        self.release_at[v] = self.age[v]
+        t = self.age[v] / self.sample_rate
+        self.release_level[v] = adsr(t, self.attack[v], self.decay[v], self.sustain[v])
+
+    # A free voice, or the one to steal: the oldest released voice, else the oldest voice
+    def _allocate(self):
+        free = np.flatnonzero(~self.active)
+        if len(free):
+            return free[0]
+        self.stolen += 1
+        released = np.flatnonzero(self.released)
+        candidates = released if len(released) else np.arange(len(self.active))
+        return candidates[np.argmax(self.age[candidates])]
+
+    # Mix every active voice into out[pos:end] and advance the voices
+    def _mix(self, out, pos, end):
+        m = end - pos
+        frames = self.frames[:m]
+        voices = np.flatnonzero(self.active)
+        if not len(voices):
+            return
+        pitched = voices[~self.drum[voices]]
+        drums = voices[self.drum[voices]]
+        if len(pitched):
+            out[pos:end] += self._pitched(pitched, frames).sum(axis=0)
+        if len(drums):
+            index = self.drum_offset[self.row[drums]][:, None] + np.minimum(
+                self.age[drums][:, None] + frames, self.drum_length[self.row[drums]][:, None])
+            out[pos:end] += (self.drum_data[index] * self.gain[drums][:, None]).sum(axis=0)
+        self.age[voices] += m
+        # voices that have died away
+        done_drums = drums[self.age[drums] >= self.drum_length[self.row[drums]]]
+        rel = pitched[self.released[pitched]]
+        done_notes = rel[(self.age[rel] - self.release_at[rel]) >= self.release[rel] * self.sample_rate]
+        self.active[done_drums] = False
+        self.active[done_notes] = False
+        self.released[done_notes] = False
+
+    # Samples (voices x frames) of pitched voices for the next len(frames) frames
+    def _pitched(self, v, frames):
+        cycles = self.phase[v][:, None] + self.step[v][:, None] * frames
+        rows = self.row[v][:, None]
+        wave_ = self._read(rows, cycles)
+        detuned = self.detune[v] > 0
+        if detuned.any():
+            d = v[detuned]
+            step = self.step[d] * self.detune[d]
+            detuned_cycles = self.detune_phase[d][:, None] + step[:, None] * frames
+            wave_[detuned] = 0.5 * (wave_[detuned] + self._read(rows[detuned], detuned_cycles))
+            self.detune_phase[d] = (self.detune_phase[d] + step * len(frames)) % 2.0
+        t = ((self.age[v][:, None] + frames) / self.sample_rate).astype(np.float32)
+        env = adsr(t, self.attack[v][:, None], self.decay[v][:, None], self.sustain[v][:, None])
+        released = self.released[v]
+        if released.any():
+            r = np.flatnonzero(released)
+            since = t[r] - (self.release_at[v][r] / self.sample_rate)[:, None]
+            fade = self.release_level[v][r][:, None] * release_ramp(since, self.release[v][r][:, None])
+            env[r] = np.where(since >= 0, fade, env[r])
+        wave_ *= env
+        drive = self.drive[v]
+        if drive.any():
+            d = np.flatnonzero(drive)
+            k = drive[d][:, None]
+            wave_[d] = np.tanh(k * wave_[d]) / np.tanh(k)
+        wave_ *= self.gain[v][:, None]
+        # advance the oscillators, wrapped to the table's two cycles
+        self.phase[v] = (self.phase[v] + self.step[v] * len(frames)) % 2.0
+        return wave_
+
+    def _read(self, rows, cycles):
+        pos = (cycles * TABLE_SIZE) % (2 * TABLE_SIZE)
+        i = pos.astype(np.int64)
+        frac = (pos - i).astype(np.float32)
+        lo = self.tables[rows, i]
+        return lo + frac * (self.tables[rows, i + 1] - lo)
+
+    def report(self):
+        report = self.block_times.as_dict()
+        report["blocks"] = report.pop("events")
+        report["budget_us"] = self.block / self.sample_rate * 1e6
+        report["seconds"] = self.sample / self.sample_rate
+        report["stolen_voices"] = self.stolen
+        return report
+
+if __name__ == "__main__":
+    import json
+
+    from eternaldisco import default_spec, eternal_events, iter_events
+
+    parser = argparse.ArgumentParser(description="Stream the song as audio blocks to stdout (raw s16le) or a WAV file.")
+    parser.add_argument("--wav", help="write a WAV file instead of raw PCM on stdout")
+    parser.add_argument("--eternal", action="store_true", help="endless song (see eternaldisco.eternal)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--seconds", type=float, default=None, help="stop after this much audio")
+    parser.add_argument("--rate", type=int, default=SAMPLE_RATE)
+    parser.add_argument("--block", type=int, default=BLOCK)
+    parser.add_argument("--voices", type=int, default=VOICES)
+    parser.add_argument("--drum-cache", help="directory to keep the drum one-shots in")
+    args = parser.parse_args()
+
+    spec = default_spec()
+    events = eternal_events(spec, args.seed) if args.eternal else iter_events(spec)
+    engine = AudioEngine(events, spec["ticks_per_beat"], args.rate, args.block, args.voices,
+                         drums=DrumCache(args.rate, args.drum_cache))
+    limit = None if args.seconds is None else int(args.seconds * args.rate / args.block)
+    if args.wav:
+        frames = None if limit is None else limit * args.block
+        with MappedWav(args.wav, args.rate, frames) as w:
+            for block in engine.blocks(limit):
+                w.write(block)
+    else:
+        write = sys.stdout.buffer.write
+        try:
+            for block in engine.blocks(limit):
+                write(to_pcm16(block).tobytes())
+        except BrokenPipeError:
+            pass
+    print(json.dumps(engine.report(), indent=2), file=sys.stderr)
@@ -0,0 +1,186 @@
+import argparse
+import gc
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from eternaldisco import build_song, default_spec
+from smf import encode_track, smf_header
+
+# Render pipeline benchmark. Every stage is timed on its own: a run calls it in a loop for at
+# least MIN_RUN_SECONDS, so fast stages are timed over many calls, and the best of `repeat`
+# runs counts:
+#   generate  section event generation (build_song)
+#   sort      packed-key sort of the event store
+#   encode    delta-time/VLQ + message encoding of the track
+#   header    MThd + MTrk chunk header assembly
+#   write     writing the file
+# for song lengths from the default 24 bars up to 1M bars, reporting events/s, bytes/event
+# and peak RSS. Results can be saved as a JSON baseline; runs compared against a baseline
+# fail (exit status 1) when a stage's throughput drops by more than the threshold. Sizes that
+# show a drop are re-run (up to CONFIRM_RUNS times, keeping each stage's best time) before
+# failing, so only slowdowns that reproduce fail the gate, not noisy runs.
+
+BASE_BARS = 24  # bars in the default arrangement
+SIZES = [24, 2400, 24000, 240000, 1000000]
+STAGES = ["generate", "sort", "encode", "header", "write"]
+MIN_RUN_SECONDS = 0.2        # shortest timed run of a stage
+MIN_COMPARE_SECONDS = 0.001  # stages faster than this per call are too noisy to compare
+CONFIRM_RUNS = 5             # re-runs of a size before a throughput drop counts
+
+# Default spec with every progression repeated to reach about `bars` bars
+def bench_spec(bars):
+    spec = default_spec()
+    repeats = max(1, bars // BASE_BARS)
+    for section, progression in spec["progressions"].items():
+        spec["progressions"][section] = progression * repeats
+    return spec
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+# Best seconds per call of `fn` over `repeat` runs of at least MIN_RUN_SECONDS each, with
+# the garbage collector off (as timeit does) so its pauses do not land in random runs
+def best_of(repeat, fn):
+    gc.collect()
+    gc.disable()
+    try:
+        return _best_of(repeat, fn)
+    finally:
+        gc.enable()
+
+def _best_of(repeat, fn):
+    best, result = None, None
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            result = fn()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= MIN_RUN_SECONDS:
+                break
+        best = elapsed / calls if best is None else min(best, elapsed / calls)
+    return best, result
+
+# Time every stage for one song length
+def run_size(bars, repeat, tmp_dir):
+    spec = bench_spec(bars)
+    times = {}
+    times["generate"], song = best_of(repeat, lambda: build_song(spec))
+    events = song.events
+
+    # sort a fresh copy in generation order each run
+    unsorted = events.subset(slice(None))
+    def sort_fresh():
+        store = unsorted.subset(slice(None))
+        store.sort()
+        return store
+    times["sort"], events = best_of(repeat, sort_fresh)
+    times["encode"], data = best_of(repeat, lambda: encode_track(events))
+
+    def header():
+        return bytes(smf_header(song.ticks_per_beat) + b"MTrk" + len(data).to_bytes(4, 'big'))
+    times["header"], head = best_of(repeat, header)
+
+    path = os.path.join(tmp_dir, "bench.mid")
+    def write():
+        with open(path, "wb") as f:
+            f.write(head)
+            f.write(data)
+    times["write"], _ = best_of(repeat, write)
+    os.remove(path)
+
+    n = len(events)
+    return {
+        "bars": bars,
+        "events": n,
+        "bytes": len(head) + len(data),
+        "bytes_per_event": (len(head) + len(data)) / n,
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": {stage: {"seconds": times[stage],
+                           "events_per_second": n / times[stage] if times[stage] > 0 else float("inf")}
+                   for stage in STAGES},
+    }
+
+def run(sizes, repeat=3):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # ascending sizes, so the peak RSS after each size is that size's peak
+        for bars in sorted(sizes):
+            results.append(run_size(bars, repeat if bars <= 24000 else 1, tmp_dir))
+    return {"python": sys.version.split()[0], "results": results}
+
+# Stages whose throughput fell more than `threshold` (0.2 = 20%) below the baseline
+def regressions(report, baseline, threshold):
+    base = {r["bars"]: r for r in baseline["results"]}
+    found = []
+    for result in report["results"]:
+        old = base.get(result["bars"])
+        if old is None:
+            continue
+        for stage in STAGES:
+            was, now = old["stages"][stage], result["stages"][stage]
+            if was["seconds"] < MIN_COMPARE_SECONDS:
+                continue
+            if now["events_per_second"] < was["events_per_second"] * (1 - threshold):
+                found.append((result["bars"], stage, was["events_per_second"], now["events_per_second"]))
+    return found
+
+# regressions() that persist when the sizes showing them are re-run; every re-run keeps the
+# better time of each stage in `report`
+def confirmed_regressions(report, baseline, threshold, repeat=3, runs=CONFIRM_RUNS):
+    found = regressions(report, baseline, threshold)
+    for _ in range(runs):
+        if not found:
+            break
+        by_bars = {r["bars"]: r for r in report["results"]}
+        for again in run(sorted({bars for bars, _, _, _ in found}), repeat)["results"]:
+            stages = by_bars[again["bars"]]["stages"]
+            for stage in STAGES:
+                if again["stages"][stage]["seconds"] < stages[stage]["seconds"]:
+                    stages[stage] = again["stages"][stage]
+        found = regressions(report, baseline, threshold)
+    return found
+
+def print_report(report):
+    print("%9s %10s %9s %8s  %s" % ("bars", "events", "B/event", "RSS MB",
+                                    "  ".join("%14s" % (s + " ev/s") for s in STAGES)))
+    for r in report["results"]:
+        print("%9d %10d %9.2f %8.1f  %s" % (
+            r["bars"], r["events"], r["bytes_per_event"], r["peak_rss_mb"],
+            "  ".join("%14.3g" % r["stages"][s]["events_per_second"] for s in STAGES)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark generation, sort, encode and write.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="song lengths in bars")
+    parser.add_argument("--max-bars", type=int, default=None, help="skip sizes above this")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="write the full report to this file")
+    parser.add_argument("--save-baseline", metavar="PATH", help="store this run as a baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="compare against a stored baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed throughput drop vs. the baseline (default 0.2 = 20%%)")
+    args = parser.parse_args()
+
+    sizes = [s for s in args.sizes if args.max_bars is None or s <= args.max_bars]
+    report = run(sizes, args.repeat)
+    print_report(report)
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = confirmed_regressions(report, baseline, args.threshold, args.repeat)
+        for bars, stage, was, now in found:
+            print("REGRESSION: %s at %d bars: %.3g -> %.3g events/s (%.0f%% slower)"
+                  % (stage, bars, was, now, 100 * (1 - now / was)), file=sys.stderr)
+        if found:
+            sys.exit(1)
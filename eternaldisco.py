@@ -1,4 +1,17 @@
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import math
+import operator
+import random
+
+import numpy as np
+
+from smf import (EventStore, MidiEvent, SMFWriter, TempoMap, META, META_TEMPO, META_END_OF_TRACK,
+                 encode_events, encode_tracks, split_tracks)
+from profiling import NULL_PROFILER, count_events, count_vlq
 
 # MIDI setup: ticks per quarter note (time resolution)
 TICKS_PER_BEAT = 96  # a common MIDI PPQ value
@@ -58,221 +71,511 @@ bass_notes = {
 }
 
 # Helper: convert a time in beats to ticks
-def beats_to_ticks(beats):
-    return int(beats * TICKS_PER_BEAT)
+def beats_to_ticks(beats, ticks_per_beat=TICKS_PER_BEAT):
+    return int(beats * ticks_per_beat)
+
+# Song spec: everything a render depends on, as plain data (so it can be copied, pickled
+# and compared). Pass a modified copy of default_spec() to render() to get a variation.
+def default_spec():
+    return {
+        "ticks_per_beat": TICKS_PER_BEAT,
+        # Program (instrument) per channel; no entry for CHAN_DRUMS (GM drum kit is implied)
+        "programs": {
+            CHAN_CLASSICAL: PROG_STRINGS,
+            CHAN_REGGAE:    PROG_ORGAN,
+            CHAN_BASS:      PROG_BASS,
+            CHAN_ROCK:      PROG_GUITAR,
+        },
+        # Tempo (BPM) set at the start of each section
+        "tempos": {"classical": 90, "reggae": 80, "rock": 120},
+        # One chord per bar (4 beats)
+        "progressions": {
+            # Progression for 4 bars: Am -> G -> F -> E, then repeat
+            "classical": ["Am", "G", "F", "E"] * 2,
+            # Am, G, F, Em, then Am, G, F, E (to introduce E major in final bar)
+            "reggae":    ["Am", "G", "F", "Em",  "Am", "G", "F", "E"],
+            # Am, G, F, E repeated twice; the pattern intensifies in the second half
+            "rock":      ["Am", "G", "F", "E",  "Am", "G", "F", "E"],
+        },
+        "chords": {
+            "classical": {k: list(v) for k, v in chords_classical.items()},
+            "reggae":    {k: list(v) for k, v in chords_reggae.items()},
+            "rock":      {k: list(v) for k, v in chords_rock.items()},
+            "bass":      {k: list(v) for k, v in bass_notes.items()},
+        },
+        # Variations: semitones to shift every pitched note (not drums), and a factor for
+        # all note-on velocities
+        "transpose": 0,
+        "velocity": 1.0,
+    }
+
+# Numbers in canonical form: integral floats as ints (120.0 and 120 render the same song)
+def _canonical(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, dict):
+        return {key: _canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    return value
+
+# Stable identity of a spec: SHA-256 of its canonical JSON form (sorted keys, no whitespace,
+# integral floats as ints)
+def spec_digest(spec):
+    canonical = json.dumps(_canonical(spec), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+# Per-render state. Everything the generator used to keep in module globals lives here,
+# so any number of songs can be built side by side (threads, batch jobs, ...).
+# `start` places the song later on the tick timeline and `templates` lets songs with the
+# same chords and resolution share rendered bars (both used by eternal()).
+class Song:
+    def __init__(self, spec, start=0, templates=None):
+        self.spec = spec
+        self.ticks_per_beat = spec["ticks_per_beat"]
+        # MIDI events, stored column-wise (see smf.EventStore)
+        self.events = EventStore()
+        # Rendered bar patterns keyed by (section, chord_name) + bar flags
+        self.templates = {} if templates is None else templates
+        # Section start times in ticks (each section is one bar of 4 beats per chord)
+        progressions = spec["progressions"]
+        self.start_classical = start
+        self.start_reggae    = self.start_classical + self.beats_to_ticks(4 * len(progressions["classical"]))
+        self.start_rock      = self.start_reggae + self.beats_to_ticks(4 * len(progressions["reggae"]))
+        self.end_time        = self.start_rock + self.beats_to_ticks(4 * len(progressions["rock"]))
+
+    def beats_to_ticks(self, beats):
+        return beats_to_ticks(beats, self.ticks_per_beat)
+
+    def add(self, time_ticks, status, data1=0, data2=0):
+        self.events.add(time_ticks, status, data1, data2)
+
+    # Bar pattern for a chord and set of bar flags, rendered on first use
+    def bar_template(self, section, chord_name, flags):
+        key = (section, chord_name) + flags
+        template = self.templates.get(key)
+        if template is None:
+            events = EventStore(64)
+            SECTION_BARS[section][0](self, events, 0, chord_name, *flags)
+            apply_variation(events, self.spec.get("transpose", 0), self.spec.get("velocity", 1.0))
+            events.sort()
+            template = self.templates[key] = BarTemplate(events)
+        return template
+
+    # Tempo changes (MIDI Meta events). We add these as FF 51 (Set Tempo).
+    def add_tempo_change(self, time_ticks, bpm):
+        self.events.add_meta(time_ticks, META_TEMPO, tempo_payload(bpm))
+
+# Transpose pitched notes and scale note-on velocities of a rendered bar in place
+def apply_variation(events, transpose=0, velocity=1.0):
+    if not transpose and velocity == 1.0:
+        return
+    _, status, data1, data2 = events.columns()
+    kind = status & 0xF0
+    notes = (kind >= 0x80) & (kind <= 0xA0)
+    if transpose:
+        pitched = notes & ((status & 0x0F) != CHAN_DRUMS)
+        data1[pitched] = np.clip(data1[pitched].astype(np.int64) + transpose, 0, 127)
+    if velocity != 1.0:
+        # note-ons only; velocity 0 (note-off) stays 0 and nothing else drops to 0
+        on = (kind == 0x90) & (data2 > 0)
+        data2[on] = np.clip(np.rint(data2[on] * velocity), 1, 127)
 
-# Prepare list to collect MIDI events as (time_in_ticks, bytes_data)
-events = []
+# Tempo meta event: 0xFF, 0x51, 0x03, followed by 3 bytes of MPQN
+def tempo_payload(bpm):
+    return tempo_mpqn(bpm).to_bytes(3, 'big')
+
+# microseconds per quarter note = 60,000,000 / BPM
+def tempo_mpqn(bpm):
+    return int(60000000 / bpm)
+
+# Tick <-> seconds conversion for a spec, built from its section tempos (see smf.TempoMap)
+def tempo_map(spec=None):
+    song = Song(default_spec() if spec is None else spec)
+    tempos = song.spec["tempos"]
+    return TempoMap(song.ticks_per_beat, [(getattr(song, "start_" + section), tempo_mpqn(tempos[section]))
+                                          for section in SECTIONS])
 
 # 1. Add Program Change events for each instrument channel at time 0
-events.append((0, bytes([0xC0 | CHAN_CLASSICAL, PROG_STRINGS])))  # classical strings
-events.append((0, bytes([0xC0 | CHAN_REGGAE,   PROG_ORGAN])))     # reggae organ
-events.append((0, bytes([0xC0 | CHAN_BASS,     PROG_BASS])))      # bass guitar
-events.append((0, bytes([0xC0 | CHAN_ROCK,     PROG_GUITAR])))    # distorted guitar
-# (No program change needed for CHAN_DRUMS; channel 9 is standard GM drum kit)
-
-# 2. Tempo changes (MIDI Meta events). We add these as FF 51 (Set Tempo).
-def add_tempo_change(time_ticks, bpm):
-    # microseconds per quarter note = 60,000,000 / BPM
-    mpqn = int(60000000 / bpm)
-    # Tempo meta event: 0xFF, 0x51, 0x03, followed by 3 bytes of MPQN
-    events.append((time_ticks, bytes([
-        0xFF, 0x51, 0x03,
-        (mpqn >> 16) & 0xFF, (mpqn >> 8) & 0xFF, mpqn & 0xFF
-    ])))
-
-# Define section start times in ticks
-start_classical = 0
-start_reggae    = beats_to_ticks(32)   # after 8 bars of 4 beats (8*4=32 beats) at 90 BPM (tick timeline continues)
-start_rock      = start_reggae + beats_to_ticks(32)  # after another 8 bars (32 beats) for reggae
-
-# Tempo changes at section boundaries:
-add_tempo_change(0, 90)               # Classical: 90 BPM at time 0
-add_tempo_change(start_reggae, 80)    # Reggae: 80 BPM at the start of reggae section (tick 3072)
-add_tempo_change(start_rock, 120)     # Rock: 120 BPM at the start of rock section (tick 6144)
-
-# 3. Classical section note events (8 bars, A minor progression repeated twice)
-# Progression for 4 bars: Am -> G -> F -> E, then repeat
-progression_classical = ["Am", "G", "F", "E"] * 2  # 8 chords (8 measures)
-for i, chord_name in enumerate(progression_classical):
-    chord_start = start_classical + beats_to_ticks(4 * i)  # each chord lasts 4 beats (one measure)
-    notes = chords_classical[chord_name]
+def add_program_changes(song):
+    for chan, prog in song.spec["programs"].items():
+        song.add(0, 0xC0 | chan, prog)
+    # (No program change needed for CHAN_DRUMS; channel 9 is standard GM drum kit)
+
+# 2. Tempo changes at section boundaries
+def add_tempo_changes(song):
+    tempos = song.spec["tempos"]
+    song.add_tempo_change(song.start_classical, tempos["classical"])  # Classical: 90 BPM at time 0
+    song.add_tempo_change(song.start_reggae, tempos["reggae"])        # Reggae: 80 BPM (tick 3072)
+    song.add_tempo_change(song.start_rock, tempos["rock"])            # Rock: 120 BPM (tick 6144)
+
+# Section builders. Each one writes a single bar starting at bar_start into `out`, which is
+# anything with an add(tick, status, data1, data2) method. A bar only depends on its chord
+# and a few flags, so bars are normally rendered once at bar_start = 0 into a BarTemplate
+# and reused with a tick offset (see Song.bar_template).
+
+# 3. Classical section note events (one sustained chord per bar)
+def classical_bar(song, out, bar_start, chord_name):
+    chord_start = bar_start  # each chord lasts 4 beats (one measure)
+    notes = song.spec["chords"]["classical"][chord_name]
     # Note On events for the chord (all notes at once)
     for pitch in notes:
-        events.append((chord_start, bytes([0x90 | CHAN_CLASSICAL, pitch, 100])))  # Note On, velocity 100
+        out.add(chord_start, 0x90 | CHAN_CLASSICAL, pitch, 100)  # Note On, velocity 100
     # Note Off events at end of measure (chord held for full 4 beats)
-    chord_end = chord_start + beats_to_ticks(4)
+    chord_end = chord_start + song.beats_to_ticks(4)
     for pitch in notes:
-        events.append((chord_end, bytes([0x80 | CHAN_CLASSICAL, pitch, 64])))     # Note Off, velocity 64 (release)
+        out.add(chord_end, 0x80 | CHAN_CLASSICAL, pitch, 64)     # Note Off, velocity 64 (release)
 
-# 4. Reggae section note events (8 bars)
-# We use the progression: Am, G, F, Em, then Am, G, F, E (to introduce E major in final bar)
-progression_reggae = ["Am", "G", "F", "Em",  "Am", "G", "F", "E"]
-for i, chord_name in enumerate(progression_reggae):
-    bar_start = start_reggae + beats_to_ticks(4 * i)
+# 4. Reggae section note events
+# (last_bar: the final reggae bar, which makes room for the transition fill)
+def reggae_bar(song, out, bar_start, chord_name, last_bar):
+    b2t = song.beats_to_ticks
+    bass = song.spec["chords"]["bass"]
     # Compute key times within the bar (in ticks)
-    beat1 = bar_start + beats_to_ticks(0)      # 0 beats into bar (bar start)
-    beat2 = bar_start + beats_to_ticks(1)      # 1 beat into bar
-    beat3 = bar_start + beats_to_ticks(2)      # 2 beats into bar
-    beat4 = bar_start + beats_to_ticks(3)      # 3 beats into bar
-    # Determine if this is the last bar (we will add a fill if so)
-    last_bar = (i == len(progression_reggae) - 1)
+    beat1 = bar_start + b2t(0)      # 0 beats into bar (bar start)
+    beat2 = bar_start + b2t(1)      # 1 beat into bar
+    beat3 = bar_start + b2t(2)      # 2 beats into bar
+    beat4 = bar_start + b2t(3)      # 3 beats into bar
     # **Bass:** play root on beat 1 and beat 3 (one-drop feel)
     # Use bass note corresponding to chord root (just the first letter, since our keys are A, G, F, E)
     root_letter = chord_name[0]  # e.g. "Am" -> "A"
-    if root_letter in bass_notes:
-        root_pitch = bass_notes[root_letter][0]
+    if root_letter in bass:
+        root_pitch = bass[root_letter][0]
         # Bass note on beat 1
-        events.append((beat1, bytes([0x90 | CHAN_BASS, root_pitch, 100])))
+        out.add(beat1, 0x90 | CHAN_BASS, root_pitch, 100)
         # Bass note off after a short duration (here, 1 beat long to separate notes)
-        events.append((beat1 + beats_to_ticks(1), bytes([0x80 | CHAN_BASS, root_pitch, 64])))
+        out.add(beat1 + b2t(1), 0x80 | CHAN_BASS, root_pitch, 64)
         # Bass note on beat 3
-        events.append((beat3, bytes([0x90 | CHAN_BASS, root_pitch, 100])))
-        events.append((beat3 + beats_to_ticks(1), bytes([0x80 | CHAN_BASS, root_pitch, 64])))
+        out.add(beat3, 0x90 | CHAN_BASS, root_pitch, 100)
+        out.add(beat3 + b2t(1), 0x80 | CHAN_BASS, root_pitch, 64)
     # **Guitar/Organ skank:** off-beat chords on beats 2 and 4
-    chord_notes = chords_reggae[chord_name]  # get the triad for this chord
+    chord_notes = song.spec["chords"]["reggae"][chord_name]  # get the triad for this chord
     # Beat 2 chord stab
     for pitch in chord_notes:
-        events.append((beat2, bytes([0x90 | CHAN_REGGAE, pitch, 90])))      # Note On at beat 2
-        events.append((beat2 + beats_to_ticks(0.5), bytes([0x80 | CHAN_REGGAE, pitch, 64])))  # Note Off after 1/2 beat
+        out.add(beat2, 0x90 | CHAN_REGGAE, pitch, 90)             # Note On at beat 2
+        out.add(beat2 + b2t(0.5), 0x80 | CHAN_REGGAE, pitch, 64)  # Note Off after 1/2 beat
     # Beat 4 chord stab (skip if we are doing a drum fill instead)
     if not last_bar:
         for pitch in chord_notes:
-            events.append((beat4, bytes([0x90 | CHAN_REGGAE, pitch, 90])))  # Note On at beat 4
-            events.append((beat4 + beats_to_ticks(0.5), bytes([0x80 | CHAN_REGGAE, pitch, 64])))  # Note Off after 1/2 beat
+            out.add(beat4, 0x90 | CHAN_REGGAE, pitch, 90)             # Note On at beat 4
+            out.add(beat4 + b2t(0.5), 0x80 | CHAN_REGGAE, pitch, 64)  # Note Off after 1/2 beat
     # **Drums:** one-drop pattern
     # Hi-hat on offbeat 8ths: (i.e., 0.5, 1.5, 2.5, 3.5 beats)
-    hi_hat_times = [bar_start + beats_to_ticks(b) for b in [0.5, 1.5, 2.5, 3.5]]
+    hi_hat_times = [bar_start + b2t(b) for b in [0.5, 1.5, 2.5, 3.5]]
     if last_bar:
         hi_hat_times.pop()  # remove the last offbeat (3.5) to allow space for fill
     for t in hi_hat_times:
-        events.append((t, bytes([0x99, HIHAT_CLOSED, 80])))  # closed hat on off-beat
+        out.add(t, 0x99, HIHAT_CLOSED, 80)  # closed hat on off-beat
     # One-drop Kick + Snare on beat 3
-    events.append((beat3, bytes([0x99, KICK, 100])))
-    events.append((beat3, bytes([0x99, SNARE, 100])))
+    out.add(beat3, 0x99, KICK, 100)
+    out.add(beat3, 0x99, SNARE, 100)
     # **Transition fill on last reggae bar:**
     if last_bar:
         # Drum fill: snare hit on beat 4, low tom on beat 4& (half-beat after beat 4)
-        events.append((beat4, bytes([0x99, SNARE, 110])))
-        events.append((beat4 + beats_to_ticks(0.5), bytes([0x99, TOM_LOW, 110])))
-        # (We will add a crash cymbal on the first beat of the rock section for the final transition)
-
-# 5. Rock/Metal section note events (8 bars)
-# Progression: Am, G, F, E repeated twice (8 bars). 
-# The pattern intensifies in the second half.
-progression_rock = ["Am", "G", "F", "E",  "Am", "G", "F", "E"]
-for j, chord_name in enumerate(progression_rock):
-    bar_start = start_rock + beats_to_ticks(4 * j)
+        out.add(beat4, 0x99, SNARE, 110)
+        out.add(beat4 + b2t(0.5), 0x99, TOM_LOW, 110)
+        # (The crash cymbal on the first beat of the rock section marks the final transition)
+
+# 5. Rock/Metal section note events
+# (double_time: the second half of the section with the double-kick pattern;
+#  first_bar: the opening bar, where a crash replaces the first hi-hat)
+def rock_bar(song, out, bar_start, chord_name, double_time, first_bar):
+    b2t = song.beats_to_ticks
+    bass = song.spec["chords"]["bass"]
     beat1 = bar_start
-    beat2 = bar_start + beats_to_ticks(1)
-    beat3 = bar_start + beats_to_ticks(2)
-    beat4 = bar_start + beats_to_ticks(3)
-    # Determine if we are in the latter half (for double bass section)
-    double_time = (j >= 4)  # bars 5-8 of rock section use double-kick pattern
+    beat2 = bar_start + b2t(1)
+    beat3 = bar_start + b2t(2)
+    beat4 = bar_start + b2t(3)
     # **Rhythm Guitar:** power chord on beat 1 and beat 3
-    guitar_notes = chords_rock[chord_name]
+    guitar_notes = song.spec["chords"]["rock"][chord_name]
     # Strum chord on beat 1
     for pitch in guitar_notes:
-        events.append((beat1, bytes([0x90 | CHAN_ROCK, pitch, 120])))
+        out.add(beat1, 0x90 | CHAN_ROCK, pitch, 120)
     # Note Off for that chord at beat 3 (so it rings for 2 beats)
     for pitch in guitar_notes:
-        events.append((beat3, bytes([0x80 | CHAN_ROCK, pitch, 64])))
+        out.add(beat3, 0x80 | CHAN_ROCK, pitch, 64)
     # Strum chord again on beat 3
     for pitch in guitar_notes:
-        events.append((beat3, bytes([0x90 | CHAN_ROCK, pitch, 120])))
+        out.add(beat3, 0x90 | CHAN_ROCK, pitch, 120)
     # Note Off at end of bar (beat 5 which is next bar's start)
     for pitch in guitar_notes:
-        events.append((beat4 + beats_to_ticks(1), bytes([0x80 | CHAN_ROCK, pitch, 64])))
+        out.add(beat4 + b2t(1), 0x80 | CHAN_ROCK, pitch, 64)
     # **Bass Guitar:** play root notes on every beat (quarter notes)
     root_letter = chord_name[0]  # "Am" -> 'A', "F" -> 'F', etc.
-    if root_letter in bass_notes:
-        bass_pitch = bass_notes[root_letter][0]
+    if root_letter in bass:
+        bass_pitch = bass[root_letter][0]
         for b in [beat1, beat2, beat3, beat4]:
-            events.append((b, bytes([0x90 | CHAN_BASS, bass_pitch, 100])))
+            out.add(b, 0x90 | CHAN_BASS, bass_pitch, 100)
             # Note Off slightly before the next beat to keep it punchy (here ~90% of the beat length)
-            events.append((b + int(0.9 * TICKS_PER_BEAT), bytes([0x80 | CHAN_BASS, bass_pitch, 64])))
-    # **Drums:** 
+            out.add(b + int(0.9 * song.ticks_per_beat), 0x80 | CHAN_BASS, bass_pitch, 64)
+    # **Drums:**
     if not double_time:
         # Standard rock beat (basic 4/4 rock groove)
-        events.append((beat1, bytes([0x99, KICK, 127])))    # Kick on 1
-        events.append((beat2, bytes([0x99, SNARE, 120])))   # Snare on 2
-        events.append((beat3, bytes([0x99, KICK, 127])))    # Kick on 3
-        events.append((beat4, bytes([0x99, SNARE, 120])))   # Snare on 4
+        out.add(beat1, 0x99, KICK, 127)    # Kick on 1
+        out.add(beat2, 0x99, SNARE, 120)   # Snare on 2
+        out.add(beat3, 0x99, KICK, 127)    # Kick on 3
+        out.add(beat4, 0x99, SNARE, 120)   # Snare on 4
         # Hi-hat every 1/2 beat (8th notes)
-        eight_times = [bar_start + beats_to_ticks(x) for x in [0, 0.5, 1, 1.5, 2, 2.5, 3, 3.5]]
+        eight_times = [bar_start + b2t(x) for x in [0, 0.5, 1, 1.5, 2, 2.5, 3, 3.5]]
         # If this is the very first rock bar, we will add a crash cymbal on beat1 (so we can omit the hat on beat1 to let the crash ring)
-        if j == 0:
+        if first_bar:
             eight_times.remove(bar_start)  # remove 0 (beat1) from hat times, as crash will be there
         for t in eight_times:
-            events.append((t, bytes([0x99, HIHAT_CLOSED, 90])))
+            out.add(t, 0x99, HIHAT_CLOSED, 90)
     else:
         # Double-time metal beat (thrash style)
         # **Double Bass**: kick drum on every 16th note subdivision (4 per beat = 16 per bar)
         t = bar_start
-        step = beats_to_ticks(0.25)  # 16th note = 0.25 beat
-        while t < bar_start + beats_to_ticks(4):
-            events.append((t, bytes([0x99, KICK, 127])))
+        step = b2t(0.25)  # 16th note = 0.25 beat
+        while t < bar_start + b2t(4):
+            out.add(t, 0x99, KICK, 127)
             t += step
         # **Snare**: on 2 and 4 as usual (can coincide with some kicks, adding power)
-        events.append((beat2, bytes([0x99, SNARE, 120])))
-        events.append((beat4, bytes([0x99, SNARE, 120])))
+        out.add(beat2, 0x99, SNARE, 120)
+        out.add(beat4, 0x99, SNARE, 120)
         # **Ride Cymbal**: to cut through, play ride on each quarter note beat
-        events.append((beat1, bytes([0x99, RIDE_CYMBAL, 100])))
-        events.append((beat2, bytes([0x99, RIDE_CYMBAL, 100])))
-        events.append((beat3, bytes([0x99, RIDE_CYMBAL, 100])))
-        events.append((beat4, bytes([0x99, RIDE_CYMBAL, 100])))
+        out.add(beat1, 0x99, RIDE_CYMBAL, 100)
+        out.add(beat2, 0x99, RIDE_CYMBAL, 100)
+        out.add(beat3, 0x99, RIDE_CYMBAL, 100)
+        out.add(beat4, 0x99, RIDE_CYMBAL, 100)
         # (The ride hits often coincide with snare on 2,4 which is common in metal drumming)
+    if first_bar:
+        # Add the transition Crash cymbal on the first beat of the rock section (to mark the genre switch)
+        out.add(bar_start, 0x99, CRASH_CYMBAL, 127)
+
+# Flags that change a bar's pattern, by position i in the section's progression
+def classical_flags(progression, i):
+    return ()
+
+def reggae_flags(progression, i):
+    # Determine if this is the last bar (we will add a fill if so)
+    return (i == len(progression) - 1,)
+
+def rock_flags(progression, i):
+    # Bars in the latter half use the double-kick pattern (bars 5-8 for 8 bars); bar 1 gets the crash
+    return (i >= len(progression) // 2, i == 0)
+
+# Sections in playing order, with the builder for one of their bars and its flags
+SECTIONS = ["classical", "reggae", "rock"]
+SECTION_BARS = {
+    "classical": (classical_bar, classical_flags),
+    "reggae":    (reggae_bar,    reggae_flags),
+    "rock":      (rock_bar,      rock_flags),
+}
+
+# One bar rendered at bar_start = 0 and sorted by packed key. `rows` holds the same events
+# as MidiEvents for the streaming path.
+class BarTemplate:
+    def __init__(self, events):
+        self.events = events
+        self.rows = [MidiEvent(*row) for row in zip(*(col.tolist() for col in events.columns()))]
+
+# (bar_start, chord_name, flags) for every bar of a section
+def section_bars(song, section):
+    flags = SECTION_BARS[section][1]
+    progression = song.spec["progressions"][section]
+    start = getattr(song, "start_" + section)
+    for i, chord_name in enumerate(progression):
+        yield start + song.beats_to_ticks(4 * i), chord_name, flags(progression, i)
+
+# Build every bar of one section into the song's event store. Bars sharing a template are
+# added in one vectorized step, so the cost follows the number of distinct bars.
+def build_section(song, section):
+    bars = {}
+    for bar_start, chord_name, flags in section_bars(song, section):
+        bars.setdefault((chord_name, flags), []).append(bar_start)
+    for (chord_name, flags), starts in bars.items():
+        song.events.extend_tiled(song.bar_template(section, chord_name, flags).events, starts)
+
+# Build every event of the song (unsorted, in generation order)
+def build_song(spec=None, profiler=None):
+    profiler = NULL_PROFILER if profiler is None else profiler
+    song = Song(default_spec() if spec is None else spec)
+    add_program_changes(song)
+    add_tempo_changes(song)
+    for section in SECTIONS:
+        before = song.events.n
+        with profiler.span("build." + section):
+            build_section(song, section)
+        profiler.count("events.section." + section, song.events.n - before)
+    # 6. End-of-track meta event
+    song.events.add_meta(song.end_time, META_END_OF_TRACK)  # End of Track (tick 9216 for the default spec)
+    return song
+
+# Streaming generation. Every section emits its bars in increasing time and no bar reaches
+# past the start of the next one, so chaining the (sorted) bar templates yields a time-ordered
+# stream; the streams are then combined with a k-way heap merge instead of a global sort.
+# Bars and streams are ordered by the same packed key as EventStore.sort (smf.event_key),
+# so both rendering paths produce identical files. Streamed events are smf.MidiEvents: the
+# key is computed once per template event and only shifted per bar, and identical channel
+# messages share one interned bytes object.
+
+# Events of one bar, as MidiEvents
+class BarEvents(list):
+    def add(self, time_ticks, status, data1=0, data2=0):
+        self.append(MidiEvent(time_ticks, status, data1, data2))
+
+stream_key = operator.attrgetter("key")
+
+# Time-ordered events of one section, optionally only those of one channel
+def section_events(song, section, channel=None):
+    for bar_start, chord_name, flags in section_bars(song, section):
+        rows = song.bar_template(section, chord_name, flags).rows
+        if channel is not None:
+            rows = [event for event in rows if (event.status & 0x0F) == channel]
+        for event in rows:
+            yield event.shifted(bar_start)
+
+# Time-ordered program changes and tempo changes (meta events as (tick, 0xFF, type, payload))
+def conductor_events(song, programs=True):
+    events = BarEvents()
+    if programs:
+        for chan, prog in song.spec["programs"].items():
+            events.add(song.start_classical, 0xC0 | chan, prog)
+    tempos = song.spec["tempos"]
+    for section in SECTIONS:
+        start = getattr(song, "start_" + section)
+        events.add(start, META, META_TEMPO, tempo_payload(tempos[section]))
+    events.sort(key=stream_key)
+    return iter(events)
+
+# All events of the song in time order, ending with End of Track
+def iter_events(spec=None):
+    song = Song(default_spec() if spec is None else spec)
+    streams = [conductor_events(song)] + [section_events(song, section) for section in SECTIONS]
+    yield from heapq.merge(*streams, key=stream_key)
+    yield MidiEvent(song.end_time, META, META_END_OF_TRACK, b"")
+
+# Eternal mode: an endless song that keeps cycling classical -> reggae -> rock. Every cycle
+# after the first varies the progressions (see evolve_progression) and continues on the same
+# tick timeline. The streams of consecutive cycles are chained and merged lazily, so nothing
+# accumulates: memory is bounded by one cycle's generators plus the bar templates (at most
+# one per section, chord and flag combination).
+
+# Vary a progression by substituting chords from the section's chord table. The first and
+# last bars (the opening chord and the cadence into the next section) are kept.
+def evolve_progression(progression, chord_names, rng, change=0.25):
+    evolved = list(progression)
+    for i in range(1, len(evolved) - 1):
+        if rng.random() < change:
+            evolved[i] = rng.choice(chord_names)
+    return evolved
+
+# Songs for consecutive cycles, each starting where the previous one ended
+def eternal_cycles(spec, seed=None):
+    rng = random.Random(seed)
+    templates = {}
+    chords = spec["chords"]
+    song = Song(spec, 0, templates)
+    while True:
+        yield song
+        cycle = dict(spec)
+        cycle["progressions"] = {
+            section: evolve_progression(progression, sorted(chords[section]), rng)
+            for section, progression in spec["progressions"].items()
+        }
+        song = Song(cycle, song.end_time, templates)
+
+# Endless time-ordered MidiEvents (meta events carry their payload in data2, as in
+# iter_events); there is no End of Track.
+def eternal_events(spec=None, seed=None):
+    spec = default_spec() if spec is None else spec
+    cycles = itertools.tee(eternal_cycles(spec, seed), 1 + len(SECTIONS))
+    chain = itertools.chain.from_iterable
+    streams = [chain(conductor_events(song, programs=song.start_classical == 0) for song in cycles[0])]
+    for section, songs in zip(SECTIONS, cycles[1:]):
+        streams.append(chain(map(section_events, songs, itertools.repeat(section))))
+    return heapq.merge(*streams, key=stream_key)
+
+# Endless song generator. With encoded=True it yields MIDI track data (delta-time + event
+# bytes, as inside an MTrk chunk) in batches of `batch` events; with encoded=False it yields
+# the timed messages of eternal_events() one by one.
+def eternal(spec=None, seed=None, encoded=True, running_status=False,
+            note_off_as_zero_velocity=False, batch=1024):
+    events = eternal_events(spec, seed)
+    if not encoded:
+        yield from events
+        return
+    pending = EventStore(batch)
+    last_tick, prev_status = 0, None
+    for event in events:
+        if event.status == META:
+            pending.add_meta(event.tick, event.data1, event.data2)
+        else:
+            pending.add(event.tick, event.status, event.data1, event.data2)
+        if pending.n == batch:
+            data, last_tick, prev_status = encode_events(
+                pending, 0, None, last_tick, prev_status, running_status, note_off_as_zero_velocity)
+            pending.clear()
+            yield data
+
+# Render a song spec to a complete Standard MIDI File
+# (running_status / note_off_as_zero_velocity: see smf.encode_events, both off by default;
+#  fmt / workers: see render_to)
+def render(spec=None, running_status=False, note_off_as_zero_velocity=False, fmt=0, workers=None,
+           profiler=None):
+    out = io.BytesIO()
+    render_to(out, spec, running_status, note_off_as_zero_velocity, fmt, workers, profiler)
+    return out.getvalue()
+
+# Render a song spec into an open binary file object.
+# fmt=0 writes a single track, streamed out in batches (see smf.SMFWriter), so the encoded
+# song is never held in memory as a whole. fmt=1 writes a conductor track (tempo changes)
+# plus one track per channel; the tracks are encoded independently, on a process pool for
+# long songs (workers: see smf.encode_tracks), and then written one after another.
+# profiler: optional profiling.Profiler that gets spans for every stage (build.<section>, sort,
+# encode, write) and event/byte counters.
+def render_to(fileobj, spec=None, running_status=False, note_off_as_zero_velocity=False,
+              fmt=0, workers=None, profiler=None):
+    if fmt not in (0, 1):
+        raise ValueError("unsupported SMF format %r (expected 0 or 1)" % (fmt,))
+    profiler = NULL_PROFILER if profiler is None else profiler
+    with profiler.span("build"):
+        song = build_song(spec, profiler)
+    # Sort events by time to ensure correct order
+    with profiler.span("sort"):
+        song.events.sort()
+    if profiler.enabled:
+        count_events(profiler, song.events)
+    writer_profiler = profiler if profiler.enabled else None
+    if fmt == 0:
+        if profiler.enabled:
+            count_vlq(profiler, song.events)
+        with profiler.span("write"):  # encode spans are nested in here (batches are interleaved)
+            with SMFWriter(fileobj, song.ticks_per_beat, running_status=running_status,
+                           note_off_as_zero_velocity=note_off_as_zero_velocity,
+                           profiler=writer_profiler) as writer:
+                writer.write_store(song.events)
+    else:
+        with profiler.span("split"):
+            stores = split_tracks(song.events)
+        if profiler.enabled:
+            for store in stores:
+                count_vlq(profiler, store)
+        with profiler.span("encode"):
+            tracks = encode_tracks(stores, running_status, note_off_as_zero_velocity, workers)
+        with profiler.span("write"):
+            with SMFWriter(fileobj, song.ticks_per_beat, fmt=1, ntracks=len(tracks),
+                           profiler=writer_profiler) as writer:
+                for midi_bytes in tracks:
+                    writer.write_track(midi_bytes)
+    return writer.bytes_written
+
+# Like render_to(), but generated bar by bar through iter_events(): nothing is sorted and
+# the first batch is written before the last bar has been generated.
+def stream_to(fileobj, spec=None, running_status=False, note_off_as_zero_velocity=False):
+    ticks_per_beat = (default_spec() if spec is None else spec)["ticks_per_beat"]
+    with SMFWriter(fileobj, ticks_per_beat, running_status=running_status,
+                   note_off_as_zero_velocity=note_off_as_zero_velocity) as writer:
+        for event in iter_events(spec):
+            if event.status == META:
+                writer.write_meta(event.tick, event.data1, event.data2)
+            else:
+                writer.write(event.tick, event.status, event.data1, event.data2)
+    return writer.bytes_written
 
-# Add the transition Crash cymbal on the first beat of the rock section (to mark the genre switch)
-events.append((start_rock, bytes([0x99, CRASH_CYMBAL, 127])))
-
-# 6. End-of-track meta event
-end_time = start_rock + beats_to_ticks(32)  # end of 8 rock bars (should be tick 9216)
-events.append((end_time, bytes([0xFF, 0x2F, 0x00])))  # End of Track
-
-# Sort events by time to ensure correct order
-events.sort(key=lambda e: e[0])
-
-# Assemble MIDI binary data from events
-midi_bytes = bytearray()
-last_time = 0
-for time, data in events:
-    # Calculate delta-time (time since last event) in ticks
-    delta = time - last_time
-    # Variable-length encoding for delta
-    # (Most significant bit in each byte indicates if another byte follows)
-    to_write = []
-    # Build bytes in reverse order
-    buffer = delta & 0x7F
-    to_write.append(buffer)
-    delta >>= 7
-    while delta:
-        buffer = (delta & 0x7F) | 0x80
-        to_write.insert(0, buffer)
-        delta >>= 7
-    # Append delta bytes
-    for b in to_write:
-        midi_bytes.append(b)
-    # Append event bytes
-    midi_bytes.extend(data)
-    last_time = time
-
-# Wrap track data with MIDI header and track header
-# MIDI Header: 6 bytes payload
-header = bytearray(b"MThd") 
-header.extend((6).to_bytes(4, 'big'))             # header length
-header.extend((0).to_bytes(2, 'big'))             # format 0 (single track)
-header.extend((1).to_bytes(2, 'big'))             # number of tracks = 1
-header.extend((TICKS_PER_BEAT).to_bytes(2, 'big'))# time division (ticks per beat)
-# Track Chunk:
-track_chunk = bytearray(b"MTrk")
-track_chunk.extend(len(midi_bytes).to_bytes(4, 'big'))
-
-# Combine header, track chunk header, and track data
-midi_data = header + track_chunk + midi_bytes
-
-# Write the MIDI data to a file
-with open("genre_blend.mid", "wb") as f:
-    f.write(midi_data)
-
-print("MIDI file 'genre_blend.mid' has been generated. You can now open it in a MIDI player or DAW.")
+if __name__ == "__main__":
+    # Write the MIDI data to a file
+    with open("genre_blend.mid", "wb") as f:
+        render_to(f)
+    print("MIDI file 'genre_blend.mid' has been generated. You can now open it in a MIDI player or DAW.")
@@ -0,0 +1,150 @@
+import hashlib
+
+from eternaldisco import (SECTIONS, Song, build_section, default_spec, spec_digest,
+                          tempo_payload)
+from smf import EventStore, META_END_OF_TRACK, META_TEMPO, encode_events, smf_header, vlq
+
+# Incremental re-rendering (format 0). The track is kept as encoded segments per section,
+# covering the events in [section start, next section start):
+#   head  the section's tempo change, which sorts before everything else at that tick
+#   body  the section's own bars, note-offs of the previous section that land exactly on the
+#         boundary, and End of Track in the last section
+# plus one segment with the program changes at tick 0. Sections with an empty progression
+# share their start tick with the next section; segments at the same tick are joined in the
+# order render() sorts their events: all heads, then the programs, then the bodies.
+#
+# A segment is encoded relative to its own start with a "cold" encoder state: its first
+# event carries an explicit status byte and a zero delta, which is left out. That makes the
+# segment bytes independent of where the segment sits and of what precedes it; when the
+# segments are joined, the seam gets the real delta (first tick - previous segment's last
+# tick) and, with running status, the first status byte is dropped if it repeats the
+# previous segment's final status. Joined this way the track is byte-identical to render().
+#
+# A section's events only depend on the spec entries in section_inputs(), so after an edit
+# only sections whose inputs changed are regenerated and only bodies that contain their
+# events are re-sorted and re-encoded (a body holding note-offs spilled from the previous
+# section is keyed on those events, not on the whole previous section); a tempo or program
+# change only re-encodes a head.
+# Sections whose code changed (e.g. a new drum pattern in rock_bar) can be passed in `dirty`
+# to force a rebuild.
+
+# The parts of a spec the events of one section are generated from
+def section_inputs(spec, section):
+    chords = spec["chords"]
+    return {
+        "ticks_per_beat": spec["ticks_per_beat"],
+        "progression": spec["progressions"][section],
+        "chords": chords[section],
+        "bass": chords["bass"] if section != "classical" else None,
+        "transpose": spec.get("transpose", 0),
+        "velocity": spec.get("velocity", 1.0),
+    }
+
+# Encoded events of one segment, see above. first/last are ticks relative to the segment start.
+class Segment:
+    def __init__(self, store, running_status=False, note_off_as_zero_velocity=False):
+        self.events = store.n
+        if not store.n:
+            self.data = b""
+            return
+        self.first = int(store.tick[0])
+        data, self.last, self.prev_status = encode_events(
+            store, 0, None, self.first, None, running_status, note_off_as_zero_velocity)
+        self.data = data[1:]  # without the first event's (zero) delta
+
+class IncrementalRenderer:
+    def __init__(self, running_status=False, note_off_as_zero_velocity=False):
+        self.running_status = running_status
+        self.note_off_as_zero_velocity = note_off_as_zero_velocity
+        self.sections = {}   # section -> (inputs digest, sorted events relative to its start)
+        self.heads = {}      # section -> (tempo, Segment)
+        self.programs = None  # (programs, Segment)
+        self.bodies = {}     # section -> (signature, Segment)
+        self.rebuilt = []    # bodies re-encoded by the last render
+
+    # Sorted events of one section, with ticks relative to the section start
+    def _section_events(self, spec, section, dirty):
+        digest = spec_digest(section_inputs(spec, section))
+        cached = self.sections.get(section)
+        if cached is None or cached[0] != digest or section in dirty:
+            song = Song(spec)
+            build_section(song, section)
+            events = song.events
+            events.tick[:events.n] -= getattr(song, "start_" + section)
+            events.sort()
+            cached = self.sections[section] = (digest, events)
+        return cached
+
+    # Render a spec to SMF bytes, reusing what the previous render already encoded.
+    # dirty: sections to regenerate even if their spec inputs did not change.
+    def render(self, spec=None, dirty=()):
+        spec = default_spec() if spec is None else spec
+        song = Song(spec)
+        starts = [getattr(song, "start_" + section) for section in SECTIONS] + [song.end_time]
+        self.rebuilt = []
+        segments = []   # (start tick, order at that tick, Segment)
+        programs = sorted(spec["programs"].items())
+        if self.programs is None or self.programs[0] != programs:
+            store = EventStore(16)
+            for chan, prog in programs:
+                store.add(0, 0xC0 | chan, prog)
+            store.sort()
+            self.programs = (programs, self._segment(store))
+        segments.append((starts[0], 1, self.programs[1]))
+        spill = None    # note-offs of the previous section on the boundary, relative to it
+        for k, section in enumerate(SECTIONS):
+            tempo = spec["tempos"][section]
+            cached = self.heads.get(section)
+            if cached is None or cached[0] != tempo:
+                store = EventStore(1)
+                store.add_meta(0, META_TEMPO, tempo_payload(tempo))
+                cached = self.heads[section] = (tempo, self._segment(store))
+            segments.append((starts[k], 0, cached[1]))
+
+            digest, events = self._section_events(spec, section, dirty)
+            length = starts[k + 1] - starts[k]
+            last = k == len(SECTIONS) - 1
+            signature = (digest, length, last, None if spill is None else _digest(spill))
+            cached = self.bodies.get(section)
+            if cached is None or cached[0] != signature or section in dirty:
+                store = EventStore(events.n + 16)
+                if spill is not None:
+                    store.extend_store(spill)
+                own = events.tick[:events.n] < length
+                store.extend_store(events if last or own.all() else events.subset(own))
+                if last:
+                    store.add_meta(length, META_END_OF_TRACK)
+                store.sort()
+                cached = self.bodies[section] = (signature, self._segment(store))
+                self.rebuilt.append(section)
+            segments.append((starts[k], 2, cached[1]))
+            spill = None
+            if events.n and int(events.tick[events.n - 1]) >= length:
+                spill = events.subset(events.tick[:events.n] >= length)
+                spill.tick[:spill.n] -= length
+        segments.sort(key=lambda segment: segment[:2])   # stable: sections stay in order
+        # Join the segments, fixing up the delta and status byte at every seam
+        parts = []
+        last_tick, prev_status = 0, None
+        for start, _, segment in segments:
+            if not segment.events:
+                continue
+            parts.append(vlq(start + segment.first - last_tick))
+            if self.running_status and prev_status is not None and segment.data[0] == prev_status:
+                parts.append(memoryview(segment.data)[1:])
+            else:
+                parts.append(segment.data)
+            last_tick, prev_status = start + segment.last, segment.prev_status
+        length = sum(len(part) for part in parts)
+        return b"".join([smf_header(song.ticks_per_beat), b"MTrk", length.to_bytes(4, 'big')] + parts)
+
+    def _segment(self, store):
+        return Segment(store, self.running_status, self.note_off_as_zero_velocity)
+
+# Digest of the events of a store (channel messages only, as spilled note-offs are)
+def _digest(store):
+    n = store.n
+    h = hashlib.sha256()
+    for column in (store.tick, store.status, store.data1, store.data2):
+        h.update(column[:n].tobytes())
+    return h.hexdigest()
@@ -0,0 +1,412 @@
+import argparse
+import asyncio
+import math
+import os
+from bisect import bisect_left, bisect_right
+import socket
+import stat
+import time
+
+import numpy as np
+
+from smf import DATA_LEN, META, META_TEMPO, TempoMap
+
+# Real-time playback: walk time-ordered smf.MidiEvents (as produced by
+# eternaldisco.iter_events / eternal_events), convert ticks to wall-clock time with a tempo
+# map and send each channel message to a sink exactly on time. The player sleeps until
+# shortly before an event and busy-waits on time.perf_counter_ns() for the rest, and keeps
+# histograms of how far each send landed from its target time.
+
+# Sinks: anything with send(message_bytes) and close()
+
+# Raw bytes to a file descriptor: FIFO, ALSA rawmidi device (/dev/snd/midiC*D*), ...
+class FdSink:
+    def __init__(self, fd, owned=True):
+        self.fd = fd
+        self.owned = owned
+
+    def send(self, message):
+        os.write(self.fd, message)
+
+    def close(self):
+        if self.owned and self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+
+# Named pipe (created if missing); blocks until a reader opens the other end
+class FifoSink(FdSink):
+    def __init__(self, path):
+        if not os.path.exists(path):
+            os.mkfifo(path)
+        elif not stat.S_ISFIFO(os.stat(path).st_mode):
+            raise ValueError("%s exists and is not a FIFO" % path)
+        FdSink.__init__(self, os.open(path, os.O_WRONLY))
+
+# ALSA rawmidi device, e.g. /dev/snd/midiC1D0 (the first card with a MIDI port by default)
+class RawMidiSink(FdSink):
+    def __init__(self, device=None):
+        if device is None:
+            device = find_rawmidi_device()
+            if device is None:
+                raise FileNotFoundError("no ALSA rawmidi device found under /dev/snd")
+        FdSink.__init__(self, os.open(device, os.O_WRONLY))
+
+def find_rawmidi_device():
+    try:
+        names = sorted(n for n in os.listdir("/dev/snd") if n.startswith("midiC"))
+    except OSError:
+        return None
+    return os.path.join("/dev/snd", names[0]) if names else None
+
+# UNIX socket client; every message goes out as one datagram (or is appended to the stream)
+class SocketSink:
+    def __init__(self, path, kind=socket.SOCK_DGRAM):
+        self.sock = socket.socket(socket.AF_UNIX, kind)
+        self.sock.connect(path)
+        self.send = self.sock.send if kind == socket.SOCK_DGRAM else self.sock.sendall
+
+    def close(self):
+        self.sock.close()
+
+# Discards everything (measures the scheduler alone)
+class NullSink:
+    def send(self, message):
+        pass
+
+    def close(self):
+        pass
+
+# Scheduling error histogram. Errors are send time minus target time in nanoseconds
+# (positive = late); bucket edges are in microseconds.
+class JitterHistogram:
+    EDGES_US = (0, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.edges_ns = [edge * 1000 for edge in self.EDGES_US]
+        self.counts = [0] * (len(self.EDGES_US) + 1)  # [< 0, 0-10us, ..., >= 10ms]
+        self.n = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.min_ns = 0
+
+    def record(self, error_ns):
+        self.counts[bisect_right(self.edges_ns, error_ns)] += 1
+        if not self.n or error_ns > self.max_ns:
+            self.max_ns = error_ns
+        if not self.n or error_ns < self.min_ns:
+            self.min_ns = error_ns
+        self.n += 1
+        self.total_ns += error_ns
+
+    # Fraction of events sent within `limit_us` of their target
+    def within(self, limit_us):
+        if not self.n:
+            return 1.0
+        i = bisect_right(self.EDGES_US, limit_us)
+        return sum(self.counts[:i]) / self.n
+
+    def as_dict(self):
+        labels = ["<0"] + ["%d-%dus" % (a, b) for a, b in zip(self.EDGES_US, self.EDGES_US[1:])]
+        labels.append(">=%dus" % self.EDGES_US[-1])
+        return {
+            "events": self.n,
+            "mean_us": self.total_ns / self.n / 1000 if self.n else 0.0,
+            "min_us": self.min_ns / 1000,
+            "max_us": self.max_ns / 1000,
+            "within_1ms": self.within(1000),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+class Player:
+    # spin_us: how long before an event to stop sleeping and start busy-waiting
+    # speed: playback rate (2.0 plays twice as fast)
+    # watch: {label: predicate(tick, status, data1, data2)} for extra histograms of the
+    #        events a predicate selects (e.g. the rock double-kick bars)
+    def __init__(self, sink, ticks_per_beat, spin_us=1500, speed=1.0, watch=None):
+        self.sink = sink
+        self.ticks_per_beat = ticks_per_beat
+        self.spin_ns = int(spin_us * 1000)
+        self.speed = speed
+        self.watch = dict(watch or {})
+        self.histograms = {"all": JitterHistogram()}
+        for label in self.watch:
+            self.histograms[label] = JitterHistogram()
+
+    # Block until perf_counter_ns() reaches target_ns: sleep most of the way, spin the rest
+    def wait_until(self, target_ns):
+        clock = time.perf_counter_ns
+        remaining = target_ns - clock()
+        if remaining > self.spin_ns:
+            time.sleep((remaining - self.spin_ns) / 1e9)
+        while clock() < target_ns:
+            pass
+
+    # Play time-ordered events. The tempo map is built from the tempo meta events as they
+    # come by, unless one is given. Returns the histogram report.
+    def play(self, events, tempo_map=None):
+        follow_tempo = tempo_map is None
+        if follow_tempo:
+            tempo_map = TempoMap(self.ticks_per_beat)
+        clock = time.perf_counter_ns
+        scale = 1000 / self.speed  # microseconds of song time -> nanoseconds of wall time
+        overall = self.histograms["all"]
+        watched = [(self.histograms[label], predicate) for label, predicate in self.watch.items()]
+        send = self.sink.send
+        start_ns = clock()
+        for event in events:
+            message = event.message  # interned, shared by every identical message
+            if message is None:
+                if follow_tempo and event.status == META and event.data1 == META_TEMPO:
+                    tempo_map.append(event.tick, int.from_bytes(event.data2, 'big'))
+                    tempo_map.trim(event.tick)   # the stream never goes back
+                continue
+            tick = event.tick
+            target_ns = start_ns + int(tempo_map.tick_to_us(tick) * scale)
+            self.wait_until(target_ns)
+            error_ns = clock() - target_ns
+            send(message)
+            overall.record(error_ns)
+            for histogram, predicate in watched:
+                if predicate(tick, event.status, event.data1, event.data2):
+                    histogram.record(error_ns)
+        return self.report()
+
+    def report(self):
+        return {label: histogram.as_dict() for label, histogram in self.histograms.items()}
+
+# Shared playback timeline: every channel message of a sorted song with its time in seconds.
+# All messages live in one contiguous bytes buffer; sessions hand out memoryview slices of
+# it, so any number of listeners share a single copy of the song.
+class Timeline:
+    def __init__(self, store, ticks_per_beat, tempo_map=None):
+        if tempo_map is None:
+            tempo_map = TempoMap.from_store(store, ticks_per_beat)
+        ticks, status, data1, data2 = store.columns()
+        channel = status < 0xF0
+        status, data1, data2 = status[channel], data1[channel], data2[channel]
+        lengths = 1 + DATA_LEN[status >> 4]
+        offsets = np.zeros(len(status) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        data = np.empty(int(offsets[-1]), dtype=np.uint8)
+        data[offsets[:-1]] = status
+        data[offsets[:-1] + 1] = data1
+        three = lengths == 3
+        data[offsets[:-1][three] + 2] = data2[three]
+        self.data = data.tobytes()
+        self.view = memoryview(self.data)
+        self.offsets = offsets.tolist()
+        self.times = tempo_map.tick_to_seconds(ticks[channel]).tolist()
+        # the song ends at its last event (End of Track), not at its last note
+        self.duration = float(tempo_map.tick_to_seconds(int(ticks[-1]))) if store.n else 0.0
+
+    @classmethod
+    def from_spec(cls, spec=None):
+        from eternaldisco import build_song
+        song = build_song(spec)
+        song.events.sort()
+        return cls(song.events, song.ticks_per_beat)
+
+    def __len__(self):
+        return len(self.times)
+
+    def message(self, i):
+        return self.view[self.offsets[i]:self.offsets[i + 1]]
+
+    # Index of the first message at or after `seconds`
+    def index_at(self, seconds):
+        return bisect_left(self.times, seconds)
+
+# One listener of an AsyncEngine, at its own position in the timeline. Messages arrive as
+# (song_seconds, message_memoryview), either through `callback` or by iterating the session:
+#     async for when, message in session: ...
+class Session:
+    def __init__(self, engine, position, loop, callback, maxsize):
+        self.engine = engine
+        self.loop = loop
+        self.callback = callback
+        self.queue = asyncio.Queue(maxsize) if callback is None else None
+        self.dropped = 0   # messages lost because the queue was full
+        self.closed = False
+        self.due = 0       # timer wheel tick of the next message
+        self.entry = None  # current (session, due) entry in the wheel
+        self.seek(position)
+
+    # Jump to `position` seconds into the song
+    def seek(self, position):
+        self.origin = self.engine.now() - position  # wall time of song time 0
+        self.index = self.engine.timeline.index_at(position)
+        if not self.closed:
+            self.engine._schedule(self)
+
+    def deliver(self, when, message):
+        if self.callback is not None:
+            self.callback(when, message)
+        else:
+            try:
+                self.queue.put_nowait((when, message))
+            except asyncio.QueueFull:
+                self.dropped += 1
+
+    # End the stream. Called from the driver, so it must not raise: if the queue is full, the
+    # oldest message makes room for the end-of-stream marker.
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.queue is not None:
+                if self.queue.full():
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                self.queue.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self.queue.get()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+# asyncio playback engine for many concurrent sessions over one shared Timeline.
+# Instead of a task (or call_later) per event, a single driver task advances a hashed timer
+# wheel every `resolution` seconds; each session sits in the slot of its next message and
+# delivers everything that is due when its slot comes up. The cost per wheel tick is the
+# number of sessions with something due, whatever their positions.
+class AsyncEngine:
+    def __init__(self, timeline, resolution=0.001, slots=1024):
+        self.timeline = timeline
+        self.resolution = resolution
+        self.wheel = [[] for _ in range(slots)]
+        self.sessions = set()
+        self.tick = 0
+        self.t0 = None
+        self.running = False
+        self._wakeup = None
+
+    def now(self):
+        loop_time = asyncio.get_running_loop().time()
+        if self.t0 is None:
+            self.t0 = loop_time
+        return loop_time
+
+    # Start a new session `position` seconds into the song (loop=True repeats forever)
+    def open_session(self, position=0.0, loop=False, callback=None, maxsize=0):
+        session = Session(self, position, loop, callback, maxsize)
+        if session.closed:
+            return session   # opened past the end: already ended, nothing to schedule
+        self.sessions.add(session)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return session
+
+    def _schedule(self, session):
+        timeline = self.timeline
+        if session.index >= len(timeline):
+            if not session.loop or not len(timeline):
+                session.close()
+                self.sessions.discard(session)
+                return
+            session.origin += timeline.duration
+            session.index = 0
+        when = session.origin + timeline.times[session.index]
+        session.due = max(math.ceil((when - self.t0) / self.resolution), self.tick + 1)
+        session.entry = (session, session.due)
+        self.wheel[session.due % len(self.wheel)].append(session.entry)
+
+    # Deliver everything due in wheel tick `tick`
+    def _advance(self, tick):
+        self.tick = tick
+        slot = self.wheel[tick % len(self.wheel)]
+        if not slot:
+            return
+        self.wheel[tick % len(self.wheel)] = []
+        horizon = self.t0 + tick * self.resolution
+        times = self.timeline.times
+        message = self.timeline.message
+        for entry in slot:
+            session, due = entry
+            if session.closed:
+                self.sessions.discard(session)
+                continue
+            if entry is not session.entry:
+                continue  # stale entry: the session was rescheduled (seek)
+            if due > tick:
+                # due in a later revolution of the wheel
+                self.wheel[due % len(self.wheel)].append(entry)
+                continue
+            i, n = session.index, len(times)
+            while i < n and session.origin + times[i] <= horizon:
+                session.deliver(times[i], message(i))
+                i += 1
+            session.index = i
+            self._schedule(session)
+
+    # Driver task: run until stop() is called
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.now()
+        self.running = True
+        self._wakeup = asyncio.Event()
+        while self.running:
+            if not self.sessions:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                # skip the empty ticks, but not those of sessions opened while idle
+                current = int((loop.time() - self.t0) / self.resolution)
+                self.tick = min([current] + [session.due - 1 for session in self.sessions])
+                continue
+            # catch up on every tick that has passed (if the loop was busy), then sleep
+            current = int((loop.time() - self.t0) / self.resolution)
+            for tick in range(self.tick + 1, current + 1):
+                self._advance(tick)
+            await asyncio.sleep(max(self.t0 + (self.tick + 1) * self.resolution - loop.time(), 0))
+
+    def stop(self):
+        self.running = False
+        for session in list(self.sessions):
+            session.close()
+        self.sessions.clear()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+# Sink from a command-line target: "null", "unix:/path/to.sock", "fifo:/path", "rawmidi[:/dev/snd/midiCxDy]"
+def open_sink(target):
+    kind, _, path = target.partition(":")
+    if kind == "null":
+        return NullSink()
+    if kind == "unix":
+        return SocketSink(path)
+    if kind == "fifo":
+        return FifoSink(path)
+    if kind == "rawmidi":
+        return RawMidiSink(path or None)
+    raise ValueError("unknown sink %r" % target)
+
+if __name__ == "__main__":
+    import json
+
+    from eternaldisco import CHAN_DRUMS, KICK, Song, default_spec, iter_events
+
+    parser = argparse.ArgumentParser(description="Play the song in real time and report scheduling jitter.")
+    parser.add_argument("sink", nargs="?", default="null",
+                        help="null | unix:PATH | fifo:PATH | rawmidi[:DEVICE] (default: null)")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--spin-us", type=float, default=1500)
+    args = parser.parse_args()
+
+    spec = default_spec()
+    song = Song(spec)
+    # The double-kick bars: second half of the rock section
+    double_kick_start = song.start_rock + song.beats_to_ticks(4 * (len(spec["progressions"]["rock"]) // 2))
+
+    def double_kick(tick, status, data1, data2):
+        return tick >= double_kick_start and status == 0x90 | CHAN_DRUMS and data1 == KICK
+
+    sink = open_sink(args.sink)
+    try:
+        player = Player(sink, spec["ticks_per_beat"], args.spin_us, args.speed,
+                        watch={"rock_double_kick": double_kick})
+        report = player.play(iter_events(spec))
+    finally:
+        sink.close()
+    print(json.dumps(report, indent=2))
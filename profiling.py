@@ -0,0 +1,104 @@
+import json
+import time
+
+import numpy as np
+
+from smf import META, SYSEX, SYSEX_ESCAPE, vlq_lengths
+
+# Render instrumentation: timed spans (monotonic clock) and counters.
+#   with profiler.span("sort"):
+#       ...
+#   profiler.count("events.meta", 3)
+# Spans with the same name are summed. Results are read back with as_dict() or written as one
+# JSON line per song with dump(); a `sink` file additionally gets one JSON line per closed span.
+# Code under instrumentation takes profiler=None and uses NULL_PROFILER, whose span() and
+# count() do nothing; counters that cost work to compute are guarded by `profiler.enabled`.
+
+class Span:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.profiler.clock()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._close(self.name, self.start, self.profiler.clock())
+
+class Profiler:
+    enabled = True
+
+    def __init__(self, sink=None, clock=time.perf_counter_ns):
+        self.sink = sink
+        self.clock = clock
+        self.spans = {}      # name -> [calls, total ns]
+        self.counters = {}
+
+    def span(self, name):
+        return Span(self, name)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def _close(self, name, start, end):
+        total = self.spans.get(name)
+        if total is None:
+            total = self.spans[name] = [0, 0]
+        total[0] += 1
+        total[1] += end - start
+        if self.sink is not None:
+            self.sink.write(json.dumps({"span": name, "start_ns": start, "ns": end - start}) + "\n")
+
+    def as_dict(self):
+        return {
+            "spans": {name: {"calls": calls, "seconds": ns / 1e9}
+                      for name, (calls, ns) in self.spans.items()},
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    # Write the totals as one JSON line, with extra fields (e.g. the song's file name)
+    def dump(self, fileobj, **fields):
+        fileobj.write(json.dumps(dict(fields, **self.as_dict())) + "\n")
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+class NullProfiler:
+    enabled = False
+
+    def span(self, name):
+        return NULL_SPAN
+
+    def count(self, name, n=1):
+        pass
+
+    def as_dict(self):
+        return {"spans": {}, "counters": {}}
+
+NULL_SPAN = NullSpan()
+NULL_PROFILER = NullProfiler()
+
+# Event counters of a store: per channel, meta and sysex events, and the total
+def count_events(profiler, store, prefix="events"):
+    status = store.status[:store.n]
+    channel = status < 0xF0
+    for ch, n in enumerate(np.bincount(status[channel] & 0x0F, minlength=16)):
+        if n:
+            profiler.count("%s.channel.%d" % (prefix, ch), n)
+    profiler.count(prefix + ".meta", np.count_nonzero(status == META))
+    profiler.count(prefix + ".sysex", np.count_nonzero((status == SYSEX) | (status == SYSEX_ESCAPE)))
+    profiler.count(prefix + ".total", store.n)
+
+# Bytes spent on delta-time VLQs when a sorted store is encoded as one track
+def count_vlq(profiler, store):
+    ticks = store.tick[:store.n]
+    profiler.count("bytes.vlq_delta", vlq_lengths(np.diff(ticks, prepend=0)).sum())
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from eternaldisco import default_spec, render, spec_digest
+
+# Content-addressed render cache. A rendered file is stored under the hash of the canonical
+# song spec (spec_digest: chords, progressions, tempos, ticks per beat, programs, ...) and the
+# render options, as <dir>/<first 2 hex digits>/<hash>.mid. Files are written to a temporary
+# name and renamed into place, so readers never see partial files and concurrent writers of
+# the same key are harmless. A hit is one file read; it also bumps the file's mtime, which
+# the size-bounded eviction uses as the LRU order. The cache size is kept as a running total
+# (one directory scan when the cache is opened), and the directory is only walked again when
+# a put takes it over max_bytes; eviction then goes down to LOW_WATER of it, so the next
+# inserts do not trigger it again.
+
+CACHE_VERSION = 1  # bump when the rendered bytes change for the same spec
+LOW_WATER = 0.9    # eviction shrinks the cache to this fraction of max_bytes
+
+class RenderCache:
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self.total = self.size()  # bytes cached, as of the last scan plus our own puts
+
+    # Cache key of a spec rendered with the given render() options
+    def key(self, spec=None, running_status=False, note_off_as_zero_velocity=False, fmt=0):
+        spec = default_spec() if spec is None else spec
+        options = [CACHE_VERSION, spec_digest(spec), bool(running_status),
+                   bool(note_off_as_zero_velocity), fmt]
+        return hashlib.sha256(json.dumps(options).encode("ascii")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".mid")
+
+    # Cached bytes of `key`, or None
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)   # most recently used
+        except FileNotFoundError:
+            pass             # evicted by another process in the meantime
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-", suffix=".mid")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            try:
+                self.total -= os.stat(path).st_size   # replaced
+            except FileNotFoundError:
+                pass
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.total += len(data)
+        if self.total > self.max_bytes:
+            self.evict()
+
+    # render() through the cache
+    def render(self, spec=None, running_status=False, note_off_as_zero_velocity=False, fmt=0):
+        key = self.key(spec, running_status, note_off_as_zero_velocity, fmt)
+        data = self.get(key)
+        if data is None:
+            data = render(spec, running_status, note_off_as_zero_velocity, fmt)
+            self.put(key, data)
+        return data
+
+    # (mtime, size, path) of every cached file
+    def entries(self):
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith(".tmp-") or not name.endswith(".mid"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    # Rescan the cache; if it is over max_bytes, delete least recently used files until it
+    # fits in LOW_WATER * max_bytes
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in entries:
+                if total <= self.max_bytes * LOW_WATER:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        self.total = total
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self.total = 0
@@ -0,0 +1,103 @@
+import argparse
+import copy
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from eternaldisco import default_spec, render_to, spec_digest
+from profiling import Profiler
+
+# Batch rendering: many song variations fanned out to a process pool, one uniquely named
+# .mid file per spec, with per-job timing and aggregate throughput.
+
+# Every combination of the given variations of a base spec.
+#   tempo_scale:  factors applied to all section tempos (e.g. 0.9 turns 90/80/120 into 81/72/108)
+#   transpose:    semitone shifts of every pitched part
+#   velocity:     note-on velocity factors
+#   progressions: replacement {section: [chords]} dicts (None keeps the base progressions)
+def spec_grid(base=None, tempo_scale=(1.0,), transpose=(0,), velocity=(1.0,), progressions=(None,)):
+    base = default_spec() if base is None else base
+    specs = []
+    for scale, shift, vel, prog in itertools.product(tempo_scale, transpose, velocity, progressions):
+        spec = copy.deepcopy(base)
+        spec["tempos"] = {section: bpm * scale for section, bpm in base["tempos"].items()}
+        spec["transpose"] = shift
+        spec["velocity"] = vel
+        if prog is not None:
+            spec["progressions"].update(copy.deepcopy(prog))
+        specs.append(spec)
+    return specs
+
+# File name of job `index`: position in the batch plus a short spec digest
+def job_name(index, spec, prefix="song"):
+    return "%s_%05d_%s.mid" % (prefix, index, spec_digest(spec)[:12])
+
+# Runs in the worker process: render one spec to its file and time it. The farm's pool is the
+# only level of parallelism: format 1 tracks are encoded in the worker itself (workers=1).
+def _render_job(job):
+    index, spec, path, profile, options = job
+    options = dict(options)
+    options.setdefault("workers", 1)
+    profiler = Profiler() if profile else None
+    start = time.perf_counter()
+    with open(path, "wb") as f:
+        size = render_to(f, spec, profiler=profiler, **options)
+    result = {"index": index, "path": path, "bytes": size, "seconds": time.perf_counter() - start}
+    if profile:
+        result["profile"] = profiler.as_dict()
+    return result
+
+# Render every spec into out_dir on a pool of `workers` processes (None: one per CPU).
+# Jobs are submitted in chunks of `chunksize` specs (default: about four chunks per worker)
+# to keep the per-task overhead low. With profile=True every job result carries its render
+# profile (profiling.Profiler.as_dict()). Extra keyword arguments go to render_to (fmt,
+# running_status, ...). Returns a report with the per-job results in input order.
+def render_batch(specs, out_dir, workers=None, chunksize=None, prefix="song", profile=False,
+                 **options):
+    os.makedirs(out_dir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    jobs = [(i, spec, os.path.join(out_dir, job_name(i, spec, prefix)), profile, options)
+            for i, spec in enumerate(specs)]
+    if chunksize is None:
+        chunksize = max(1, len(jobs) // (workers * 4))
+    start = time.perf_counter()
+    if workers == 1:
+        results = [_render_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_render_job, jobs, chunksize=chunksize))
+    wall = time.perf_counter() - start
+    return {
+        "jobs": results,
+        "songs": len(results),
+        "bytes": sum(r["bytes"] for r in results),
+        "wall_seconds": wall,
+        "songs_per_second": len(results) / wall if wall > 0 else float("inf"),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render a grid of song variations to .mid files.")
+    parser.add_argument("out_dir")
+    parser.add_argument("--tempo-scale", type=float, nargs="+", default=[1.0])
+    parser.add_argument("--transpose", type=int, nargs="+", default=[0])
+    parser.add_argument("--velocity", type=float, nargs="+", default=[1.0])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=None)
+    parser.add_argument("--format", type=int, choices=(0, 1), default=0)
+    parser.add_argument("--running-status", action="store_true")
+    parser.add_argument("--profile", metavar="PATH", help="write per-song profiles as JSON lines")
+    args = parser.parse_args()
+    specs = spec_grid(tempo_scale=args.tempo_scale, transpose=args.transpose, velocity=args.velocity)
+    report = render_batch(specs, args.out_dir, args.workers, args.chunksize,
+                          profile=bool(args.profile), fmt=args.format,
+                          running_status=args.running_status)
+    if args.profile:
+        with open(args.profile, "w") as f:
+            for job in report["jobs"]:
+                f.write(json.dumps(dict(path=job["path"], seconds=job["seconds"], **job["profile"])) + "\n")
+    for job in report["jobs"]:
+        print("%s  %7d bytes  %8.2f ms" % (job["path"], job["bytes"], job["seconds"] * 1000))
+    print("%d songs in %.2f s (%.1f songs/s)"
+          % (report["songs"], report["wall_seconds"], report["songs_per_second"]))
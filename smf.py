@@ -0,0 +1,857 @@
+import mmap
+import os
+import shutil
+import tempfile
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Standard MIDI File (SMF) building blocks: a columnar event store and the track/file writer.
+
+META   = 0xFF  # status byte of meta events (data1 holds the meta type, e.g. 0x51 = Set Tempo)
+SYSEX  = 0xF0  # status byte of system exclusive events (payload includes the closing 0xF7)
+SYSEX_ESCAPE = 0xF7  # "escape" sysex event (raw bytes, e.g. continuation packets)
+
+META_TEMPO        = 0x51
+META_END_OF_TRACK = 0x2F
+
+# Number of data bytes that follow a channel status byte (indexed by the high nibble)
+# Program Change (0xC_) and Channel Pressure (0xD_) take one data byte, everything else two.
+DATA_LEN = np.zeros(16, dtype=np.int64)
+DATA_LEN[0x8:0xF] = 2
+DATA_LEN[0xC] = 1
+DATA_LEN[0xD] = 1
+
+# Same-tick ordering. Events sort by a packed 64-bit key
+#     tick << 24 | priority << 16 | channel << 8 | data1
+# so at equal ticks meta events come first, then setup messages (program/control change,
+# pitch bend), then note-offs, then note-ons; End of Track always comes last. Ties are broken
+# by channel and key number, which makes the order independent of generation order.
+PRIORITY_META     = 0
+PRIORITY_SETUP    = 1
+PRIORITY_NOTE_OFF = 2
+PRIORITY_NOTE_ON  = 3
+PRIORITY_LAST     = 255
+
+# Priority of channel messages by high nibble of the status byte
+CHANNEL_PRIORITY = [PRIORITY_META] * 8 + [
+    PRIORITY_NOTE_OFF,  # 0x8_ Note Off
+    PRIORITY_NOTE_ON,   # 0x9_ Note On (velocity 0 counts as Note Off)
+    PRIORITY_NOTE_ON,   # 0xA_ Polyphonic Key Pressure
+    PRIORITY_SETUP,     # 0xB_ Control Change
+    PRIORITY_SETUP,     # 0xC_ Program Change
+    PRIORITY_NOTE_ON,   # 0xD_ Channel Pressure
+    PRIORITY_SETUP,     # 0xE_ Pitch Bend
+    PRIORITY_META,      # 0xF_ meta / sysex
+]
+_CHANNEL_PRIORITY = np.array(CHANNEL_PRIORITY, dtype=np.uint8)
+
+def event_priority(status, data1=0, data2=0):
+    if status == META:
+        return PRIORITY_LAST if data1 == META_END_OF_TRACK else PRIORITY_META
+    if status & 0xF0 == 0x90 and data2 == 0:
+        return PRIORITY_NOTE_OFF
+    return CHANNEL_PRIORITY[status >> 4]
+
+# Packed sort key of a single event (same layout as EventStore.sort_keys)
+def event_key(tick, status, data1=0, data2=0):
+    channel = status & 0x0F if status < 0xF0 else 0
+    return (tick << 24) | (event_priority(status, data1, data2) << 16) | (channel << 8) | (data1 & 0xFF)
+
+# Interned channel messages: one shared immutable bytes object per distinct message, so the
+# streaming and playback paths never allocate message bytes per event
+_messages = {}
+
+def channel_message(status, data1=0, data2=0):
+    key = (status << 16) | (data1 << 8) | data2
+    message = _messages.get(key)
+    if message is None:
+        if DATA_LEN[status >> 4] == 1:
+            message = bytes((status, data1))
+        else:
+            message = bytes((status, data1, data2))
+        message = _messages[key] = message
+    return message
+
+# One timed event of the streaming path. `key` is the packed sort key (event_key), computed
+# once; `message` is the interned channel message, None for meta/sysex events (whose payload
+# is in data2). Unpacks like a (tick, status, data1, data2) tuple.
+class MidiEvent:
+    __slots__ = ("key", "tick", "status", "data1", "data2", "message")
+
+    def __init__(self, tick, status, data1=0, data2=0):
+        self.key = event_key(tick, status, data1, data2)
+        self.tick = tick
+        self.status = status
+        self.data1 = data1
+        self.data2 = data2
+        self.message = channel_message(status, data1, data2) if status < 0xF0 else None
+
+    # The same event `offset` ticks later (shares the message; the key moves with the tick)
+    def shifted(self, offset):
+        event = _new_event(MidiEvent)
+        event.key = self.key + (offset << 24)
+        event.tick = self.tick + offset
+        event.status = self.status
+        event.data1 = self.data1
+        event.data2 = self.data2
+        event.message = self.message
+        return event
+
+    def __iter__(self):
+        return iter((self.tick, self.status, self.data1, self.data2))
+
+    def __repr__(self):
+        return "MidiEvent(%r, 0x%02X, %r, %r)" % (self.tick, self.status, self.data1, self.data2)
+
+_new_event = object.__new__
+
+# Events stored as a structure of arrays instead of a list of (tick, bytes) tuples.
+# One channel message costs 16 bytes; meta/sysex events additionally keep their payload in
+# a single shared bytearray, addressed through an offset table (ext -> payload[start:end]).
+class EventStore:
+    def __init__(self, capacity=256):
+        capacity = max(int(capacity), 1)
+        self.n = 0
+        self.tick     = np.empty(capacity, dtype=np.int64)
+        self.status   = np.empty(capacity, dtype=np.uint8)
+        self.data1    = np.empty(capacity, dtype=np.uint8)
+        self.data2    = np.empty(capacity, dtype=np.uint8)
+        self.priority = np.empty(capacity, dtype=np.uint8)
+        self.ext      = np.empty(capacity, dtype=np.int32)   # payload index, -1 for channel messages
+        # Variable-length payloads of meta/sysex events
+        self.payload = bytearray()
+        self.payload_offsets = [0]
+
+    def __len__(self):
+        return self.n
+
+    # Drop all events, keeping the allocated capacity
+    def clear(self):
+        self.n = 0
+        self.payload = bytearray()
+        self.payload_offsets = [0]
+
+    # Make room for `extra` more events, doubling the capacity (amortized O(1) appends)
+    def reserve(self, extra):
+        need = self.n + extra
+        capacity = len(self.tick)
+        if need <= capacity:
+            return
+        while capacity < need:
+            capacity *= 2
+        for name in ("tick", "status", "data1", "data2", "priority", "ext"):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    # Append one channel message (e.g. add(t, 0x90 | chan, pitch, velocity))
+    def add(self, tick, status, data1=0, data2=0, priority=None):
+        if priority is None:
+            priority = event_priority(status, data1, data2)
+        if self.n == len(self.tick):
+            self.reserve(1)
+        i = self.n
+        self.tick[i] = tick
+        self.status[i] = status
+        self.data1[i] = data1
+        self.data2[i] = data2
+        self.priority[i] = priority
+        self.ext[i] = -1
+        self.n = i + 1
+
+    def _add_payload(self, tick, status, data1, payload, priority):
+        self.add(tick, status, data1, 0, priority)
+        self.ext[self.n - 1] = len(self.payload_offsets) - 1
+        self.payload.extend(payload)
+        self.payload_offsets.append(len(self.payload))
+
+    # Append a meta event (FF <type> <len> <payload>)
+    def add_meta(self, tick, meta_type, payload=b"", priority=None):
+        if priority is None:
+            priority = event_priority(META, meta_type)
+        self._add_payload(tick, META, meta_type, payload, priority)
+
+    # Append a system exclusive event (F0 <len> <payload>)
+    def add_sysex(self, tick, payload, priority=PRIORITY_META):
+        self._add_payload(tick, SYSEX, 0, payload, priority)
+
+    # Append many channel messages at once (scalars broadcast)
+    def extend(self, tick, status, data1, data2=0, priority=None):
+        tick = np.asarray(tick, dtype=np.int64)
+        count = tick.size
+        self.reserve(count)
+        i, j = self.n, self.n + count
+        self.tick[i:j] = tick
+        self.status[i:j] = status
+        self.data1[i:j] = data1
+        self.data2[i:j] = data2
+        if priority is None:
+            status, data2 = self.status[i:j], self.data2[i:j]
+            priority = np.where(((status & 0xF0) == 0x90) & (data2 == 0),
+                                PRIORITY_NOTE_OFF, _CHANNEL_PRIORITY[status >> 4])
+        self.priority[i:j] = priority
+        self.ext[i:j] = -1
+        self.n = j
+
+    # Append all events of another store, shifted by tick_offset
+    def extend_store(self, other, tick_offset=0):
+        count = other.n
+        self.reserve(count)
+        i, j = self.n, self.n + count
+        self.tick[i:j] = other.tick[:count] + tick_offset
+        self.status[i:j] = other.status[:count]
+        self.data1[i:j] = other.data1[:count]
+        self.data2[i:j] = other.data2[:count]
+        self.priority[i:j] = other.priority[:count]
+        ext = other.ext[:count]
+        self.ext[i:j] = np.where(ext >= 0, ext + (len(self.payload_offsets) - 1), -1)
+        base = len(self.payload)
+        self.payload.extend(other.payload)
+        self.payload_offsets.extend(base + off for off in other.payload_offsets[1:])
+        self.n = j
+
+    # Append the events of `other` once per offset (e.g. one bar pattern at many bar starts)
+    def extend_tiled(self, other, offsets):
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if len(other.payload_offsets) > 1:
+            for offset in offsets.tolist():
+                self.extend_store(other, offset)
+            return
+        count = other.n
+        self.reserve(count * len(offsets))
+        i, j = self.n, self.n + count * len(offsets)
+        self.tick[i:j] = (offsets[:, None] + other.tick[:count]).ravel()
+        for name in ("status", "data1", "data2", "priority"):
+            getattr(self, name)[i:j] = np.tile(getattr(other, name)[:count], len(offsets))
+        self.ext[i:j] = -1
+        self.n = j
+
+    def payload_of(self, i):
+        e = self.ext[i]
+        if e < 0:
+            return b""
+        return bytes(self.payload[self.payload_offsets[e]:self.payload_offsets[e + 1]])
+
+    # Packed int64 sort keys: tick << 24 | priority << 16 | channel << 8 | data1
+    def sort_keys(self):
+        n = self.n
+        status = self.status[:n]
+        channel = np.where(status < 0xF0, status & 0x0F, 0).astype(np.int64)
+        return ((self.tick[:n] << 24) | (self.priority[:n].astype(np.int64) << 16)
+                | (channel << 8) | self.data1[:n])
+
+    # Reorder events in place by their packed keys (one native integer sort; remaining
+    # ties, i.e. duplicate messages, keep insertion order)
+    def sort(self):
+        self.permute(np.argsort(self.sort_keys(), kind="stable"))
+
+    def permute(self, order):
+        n = self.n
+        for name in ("tick", "status", "data1", "data2", "priority", "ext"):
+            col = getattr(self, name)
+            col[:n] = col[:n][order]
+
+    # New store with the events at `index` (an index array or boolean mask), in that order.
+    # The payload table is shared as is, so meta/sysex events keep their payloads.
+    def subset(self, index):
+        n = self.n
+        sub = EventStore(0)
+        for name in ("tick", "status", "data1", "data2", "priority", "ext"):
+            setattr(sub, name, getattr(self, name)[:n][index].copy())
+        sub.n = len(sub.tick)
+        if sub.n == 0:
+            sub.reserve(1)
+        sub.payload = self.payload
+        sub.payload_offsets = self.payload_offsets
+        return sub
+
+    # Columns trimmed to the stored events (views, no copy)
+    def columns(self):
+        n = self.n
+        return self.tick[:n], self.status[:n], self.data1[:n], self.data2[:n]
+
+    # Footprint of the columns and payloads in bytes
+    def nbytes(self):
+        cols = (self.tick, self.status, self.data1, self.data2, self.priority, self.ext)
+        return sum(c.nbytes for c in cols) + len(self.payload) + 8 * len(self.payload_offsets)
+
+# Variable-length quantity (most significant bit in each byte indicates if another byte follows)
+def vlq(value):
+    out = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        out.insert(0, (value & 0x7F) | 0x80)
+        value >>= 7
+    return out
+
+# Number of VLQ bytes needed for each value of a non-negative integer array
+def vlq_lengths(values):
+    values = np.asarray(values, dtype=np.int64)
+    lengths = np.ones(values.shape, dtype=np.int64)
+    rest = values >> 7
+    while rest.any():
+        lengths += rest > 0
+        rest >>= 7
+    return lengths
+
+# Write the VLQ encoding of values[i] at out[pos[i]:pos[i] + lengths[i]]
+def _vlq_scatter(out, pos, values, lengths):
+    if not len(values):
+        return
+    for k in range(int(lengths.max())):
+        m = lengths > k
+        shift = 7 * (lengths[m] - 1 - k)
+        # every byte but the last one of a quantity gets the continuation bit
+        out[pos[m] + k] = ((values[m] >> shift) & 0x7F) | np.where(k < lengths[m] - 1, 0x80, 0)
+
+# Batch VLQ encoder: returns the encoded byte stream (uint8 array) and offsets, where
+# value i occupies data[offsets[i]:offsets[i + 1]]
+def vlq_encode(values):
+    values = np.asarray(values, dtype=np.int64)
+    if (values < 0).any():
+        raise ValueError("VLQ values must be non-negative")
+    lengths = vlq_lengths(values)
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    data = np.empty(int(offsets[-1]), dtype=np.uint8)
+    _vlq_scatter(data, offsets[:-1], values, lengths)
+    return data, offsets
+
+# Encode events [start:stop) of a store as MIDI track data (events are written in store order).
+# Each event is <delta VLQ><status><data...>, or for meta/sysex <FF type|F0><len VLQ><payload>;
+# all of it is laid out with array operations, only the payload copy touches a few Python ints.
+#
+# running_status=True omits a channel status byte when it repeats the previous event's
+# (meta and sysex events cancel running status, so the next channel message restates it).
+# note_off_as_zero_velocity=True writes Note Off (8n k v) as Note On with velocity 0 (9n k 0),
+# which lets note-offs join the surrounding note-on runs.
+#
+# last_tick / prev_status carry the writer state from the previously encoded events, so a
+# track can be encoded in pieces. Returns (data, last_tick, prev_status) for the next piece.
+def encode_events(store, start=0, stop=None, last_tick=0, prev_status=None,
+                  running_status=False, note_off_as_zero_velocity=False):
+    stop = store.n if stop is None else stop
+    ticks, status, data1, data2 = (col[start:stop] for col in store.columns())
+    n = len(ticks)
+    if not n:
+        return b"", last_tick, prev_status
+    if note_off_as_zero_velocity:
+        note_off = (status & 0xF0) == 0x80
+        status = np.where(note_off, status | 0x10, status).astype(np.uint8)
+        data2 = np.where(note_off, 0, data2).astype(np.uint8)
+    # Delta-times (time since last event) in ticks
+    deltas = np.diff(ticks, prepend=last_tick)
+    if (deltas < 0).any():
+        raise ValueError("events must be sorted by tick before encoding")
+    delta_len = vlq_lengths(deltas)
+    # Message sizes: channel messages are status + 1 or 2 data bytes
+    is_meta = status == META
+    is_sysex = (status == SYSEX) | (status == SYSEX_ESCAPE)
+    msg_len = 1 + DATA_LEN[status >> 4]
+    # Channel messages that can reuse the previous status byte
+    omit = np.zeros(n, dtype=bool)
+    if running_status:
+        omit[0] = status[0] == prev_status
+        omit[1:] = (status[1:] == status[:-1]) & (status[1:] < 0xF0)
+    # Meta/sysex: status (+ type) + length VLQ + payload
+    special = np.flatnonzero(is_meta | is_sysex)
+    offsets = np.asarray(store.payload_offsets, dtype=np.int64)
+    ext = store.ext[start:stop][special]
+    pay_start = offsets[ext]
+    pay_len = offsets[ext + 1] - pay_start
+    pay_len_len = vlq_lengths(pay_len)
+    head_len = np.where(is_meta[special], 2, 1)
+    msg_len[special] = head_len + pay_len_len + pay_len
+    # Byte offset of every event in the track
+    sizes = delta_len + msg_len - omit
+    starts = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(sizes, out=starts[1:])
+    out = np.empty(int(starts[-1]), dtype=np.uint8)
+    starts = starts[:-1]
+    _vlq_scatter(out, starts, deltas, delta_len)
+    p = starts + delta_len
+    out[p[~omit]] = status[~omit]
+    # Data bytes of channel messages (and the type byte of meta events)
+    d = p + 1 - omit
+    has_d1 = (msg_len >= 2) & ~is_sysex
+    out[d[has_d1]] = data1[has_d1]
+    has_d2 = (msg_len == 3) & ~is_meta & ~is_sysex
+    out[d[has_d2] + 1] = data2[has_d2]
+    # Payload length and payload of meta/sysex events
+    if len(special):
+        q = p[special] + head_len
+        _vlq_scatter(out, q, pay_len, pay_len_len)
+        dst = q + pay_len_len
+        total = int(pay_len.sum())
+        if total:
+            within = np.arange(total) - np.repeat(np.cumsum(pay_len) - pay_len, pay_len)
+            payload = np.frombuffer(bytes(store.payload), dtype=np.uint8)
+            out[np.repeat(dst, pay_len) + within] = payload[np.repeat(pay_start, pay_len) + within]
+    # Running status is in effect after a channel message, cancelled after meta/sysex
+    last_status = int(status[-1])
+    return out.tobytes(), int(ticks[-1]), (last_status if last_status < 0xF0 else None)
+
+# Assemble MIDI track data from a whole event store (see encode_events)
+def encode_track(store, running_status=False, note_off_as_zero_velocity=False):
+    return encode_events(store, running_status=running_status,
+                         note_off_as_zero_velocity=note_off_as_zero_velocity)[0]
+
+# Split a sorted format-0 event store into format-1 tracks: a conductor track with the meta
+# and sysex events (tempo map), followed by one track per channel in channel order. Every
+# track ends with its own End of Track at the original end tick.
+def split_tracks(store):
+    ticks, status, data1, _ = store.columns()
+    eot = (status == META) & (data1 == META_END_OF_TRACK)
+    end_tick = int(ticks[eot].max()) if eot.any() else (int(ticks[-1]) if store.n else 0)
+    channel_msg = status < 0xF0
+    masks = [~channel_msg & ~eot]
+    for chan in np.unique(status[channel_msg] & 0x0F).tolist():
+        masks.append(channel_msg & ((status & 0x0F) == chan))
+    tracks = []
+    for mask in masks:
+        track = store.subset(mask)
+        track.payload = bytearray(track.payload)  # don't grow the shared payload table
+        track.payload_offsets = list(track.payload_offsets)
+        track.add_meta(end_tick, META_END_OF_TRACK)
+        tracks.append(track)
+    return tracks
+
+# Tempo map: converts between ticks and wall-clock seconds. Tempo segments are kept with
+# prefix-summed microsecond offsets, so a single lookup is a bisect (O(log n)) and array
+# lookups are one searchsorted. Segments can be appended as playback goes on (eternal mode).
+DEFAULT_MPQN = 500000  # 120 BPM, the SMF default until the first Set Tempo
+
+class TempoMap:
+    def __init__(self, ticks_per_beat, changes=()):
+        self.ticks_per_beat = ticks_per_beat
+        # segment i starts at ticks[i] (= us[i] microseconds) and runs at mpqn[i]
+        self.ticks = [0]
+        self.us = [0.0]
+        self.mpqn = [DEFAULT_MPQN]
+        self._arrays = None
+        for tick, mpqn in changes:
+            self.append(tick, mpqn)
+
+    # Tempo changes (FF 51) of a sorted event store
+    @classmethod
+    def from_store(cls, store, ticks_per_beat):
+        ticks, status, data1, _ = store.columns()
+        tempo = np.flatnonzero((status == META) & (data1 == META_TEMPO))
+        return cls(ticks_per_beat, [(int(ticks[i]), int.from_bytes(store.payload_of(i), 'big'))
+                                    for i in tempo])
+
+    # Add a tempo change at `tick` (not before the last one; same tick replaces it)
+    def append(self, tick, mpqn):
+        last = self.ticks[-1]
+        if tick < last:
+            raise ValueError("tempo changes must be appended in time order")
+        if tick == last:
+            self.mpqn[-1] = mpqn
+        else:
+            self.us.append(self.us[-1] + (tick - last) * self.mpqn[-1] / self.ticks_per_beat)
+            self.ticks.append(tick)
+            self.mpqn.append(mpqn)
+        self._arrays = None
+
+    # Drop the segments that end at or before `tick`, for maps that grow as a stream plays;
+    # ticks before `tick` can no longer be converted.
+    def trim(self, tick):
+        i = bisect_right(self.ticks, tick) - 1
+        if i > 0:
+            del self.ticks[:i]
+            del self.us[:i]
+            del self.mpqn[:i]
+            self._arrays = None
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = (np.array(self.ticks, dtype=np.int64),
+                            np.array(self.us, dtype=np.float64),
+                            np.array(self.mpqn, dtype=np.float64))
+        return self._arrays
+
+    # Microseconds from tick 0 to `tick` (scalar)
+    def tick_to_us(self, tick):
+        i = self._segment(tick)
+        return self.us[i] + (tick - self.ticks[i]) * self.mpqn[i] / self.ticks_per_beat
+
+    # Seconds at which `ticks` play; scalars give a float, arrays an array
+    def tick_to_seconds(self, ticks):
+        if np.ndim(ticks) == 0:
+            return self.tick_to_us(ticks) / 1e6
+        ticks = np.asarray(ticks)
+        t, us, mpqn = self.arrays()
+        i = np.searchsorted(t, ticks, side="right") - 1
+        if i.size and int(i.min()) < 0:
+            raise ValueError("tick %d is before the tempo map (starts at %d)" % (ticks.min(), t[0]))
+        return (us[i] + (ticks - t[i]) * mpqn[i] / self.ticks_per_beat) / 1e6
+
+    # Inverse of tick_to_seconds (fractional ticks; round or floor as the caller needs)
+    def seconds_to_tick(self, seconds):
+        if np.ndim(seconds) == 0:
+            us = seconds * 1e6
+            i = max(bisect_right(self.us, us) - 1, 0)
+            return self.ticks[i] + (us - self.us[i]) * self.ticks_per_beat / self.mpqn[i]
+        us = np.asarray(seconds, dtype=np.float64) * 1e6
+        t, offsets, mpqn = self.arrays()
+        i = np.maximum(np.searchsorted(offsets, us, side="right") - 1, 0)
+        return t[i] + (us - offsets[i]) * self.ticks_per_beat / mpqn[i]
+
+    # BPM in effect at `tick`
+    def bpm_at(self, tick):
+        return 60000000 / self.mpqn[self._segment(tick)]
+
+    # Index of the segment `tick` falls in
+    def _segment(self, tick):
+        i = bisect_right(self.ticks, tick) - 1
+        if i < 0:
+            raise ValueError("tick %d is before the tempo map (starts at %d)" % (tick, self.ticks[0]))
+        return i
+
+# Below this many events, encoding on a process pool costs more than it saves
+PARALLEL_MIN_EVENTS = 200000
+
+def _encode_track_job(args):
+    store, running_status, note_off_as_zero_velocity = args
+    return encode_track(store, running_status, note_off_as_zero_velocity)
+
+# Encode independent tracks, in parallel on a process pool when it pays off.
+# workers=None uses one process per CPU; workers=1 always encodes in this process.
+def encode_tracks(stores, running_status=False, note_off_as_zero_velocity=False, workers=None):
+    jobs = [(store, running_status, note_off_as_zero_velocity) for store in stores]
+    workers = os.cpu_count() or 1 if workers is None else workers
+    workers = min(workers, len(jobs))
+    if workers <= 1 or sum(store.n for store in stores) < PARALLEL_MIN_EVENTS:
+        return [_encode_track_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_encode_track_job, jobs))
+
+# MIDI Header chunk: 6 bytes payload
+def smf_header(ticks_per_beat, fmt=0, ntracks=1):
+    header = bytearray(b"MThd")
+    header.extend((6).to_bytes(4, 'big'))               # header length
+    header.extend((fmt).to_bytes(2, 'big'))             # format (0 = single track)
+    header.extend((ntracks).to_bytes(2, 'big'))         # number of tracks
+    header.extend((ticks_per_beat).to_bytes(2, 'big'))  # time division (ticks per beat)
+    return header
+
+# Track chunk: "MTrk" + 4-byte length + track data
+def track_chunk(midi_bytes):
+    chunk = bytearray(b"MTrk")
+    chunk.extend(len(midi_bytes).to_bytes(4, 'big'))
+    chunk.extend(midi_bytes)
+    return chunk
+
+# Streaming SMF writer: events are encoded in batches and written to the file object as they
+# arrive, so memory stays bounded by the batch size however long the song is. The MTrk length
+# is only known at the end of the track; on seekable files a placeholder is written and
+# back-patched by end_track(). Non-seekable outputs (pipes, sockets, and files opened for
+# appending, where every write goes to the end whatever the position) fall back to spooling
+# the encoded batches to a temporary file (in memory up to SPOOL_BYTES, then on disk) and
+# copying it out after the length when the track ends.
+class SMFWriter:
+    BATCH = 65536  # events encoded per batch
+    SPOOL_BYTES = 1 << 20  # track bytes kept in memory before spooling to disk
+
+    def __init__(self, fileobj, ticks_per_beat, fmt=0, ntracks=1,
+                 running_status=False, note_off_as_zero_velocity=False, profiler=None):
+        self.fileobj = fileobj
+        self.profiler = profiler  # optional profiling.Profiler: "encode" spans and file bytes
+        self.running_status = running_status
+        self.note_off_as_zero_velocity = note_off_as_zero_velocity
+        try:
+            self.seekable = fileobj.seekable() and "a" not in str(getattr(fileobj, "mode", ""))
+        except AttributeError:
+            self.seekable = False
+        self.ntracks = ntracks
+        self.tracks_written = 0
+        self.pending = EventStore(1024)   # single events waiting to be encoded
+        self.track_open = False
+        self.bytes_written = 0
+        self._write(smf_header(ticks_per_beat, fmt, ntracks))
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.bytes_written += len(data)
+
+    def _encode(self, store, start, stop):
+        return encode_events(store, start, stop, self.last_tick, self.prev_status,
+                             self.running_status, self.note_off_as_zero_velocity)
+
+    def begin_track(self):
+        if self.track_open:
+            raise ValueError("previous track has not been ended")
+        self.track_open = True
+        self.last_tick = 0
+        self.prev_status = None
+        self.length = 0
+        if self.seekable:
+            self.length_pos = self.fileobj.tell() + 4
+            self._write(b"MTrk\x00\x00\x00\x00")
+        else:
+            self.spool = tempfile.SpooledTemporaryFile(self.SPOOL_BYTES)
+
+    def _emit(self, data):
+        if not data:
+            return
+        self.length += len(data)
+        if self.seekable:
+            self._write(data)
+        else:
+            self.spool.write(data)
+
+    # Encode events [start:stop) of a sorted store, continuing from the previous events
+    def write_store(self, store, start=0, stop=None):
+        if not self.track_open:
+            self.begin_track()
+        self.flush()
+        stop = store.n if stop is None else stop
+        for i in range(start, stop, self.BATCH):
+            end = min(i + self.BATCH, stop)
+            if self.profiler is None:
+                data, self.last_tick, self.prev_status = self._encode(store, i, end)
+            else:
+                with self.profiler.span("encode"):
+                    data, self.last_tick, self.prev_status = self._encode(store, i, end)
+            self._emit(data)
+
+    # Queue single events (ticks must not go backwards)
+    def write(self, tick, status, data1=0, data2=0):
+        if not self.track_open:
+            self.begin_track()
+        self.pending.add(tick, status, data1, data2)
+        if self.pending.n >= self.BATCH:
+            self.flush()
+
+    def write_meta(self, tick, meta_type, payload=b""):
+        if not self.track_open:
+            self.begin_track()
+        self.pending.add_meta(tick, meta_type, payload)
+        if self.pending.n >= self.BATCH:
+            self.flush()
+
+    # Encode and write queued single events
+    def flush(self):
+        if not self.track_open:
+            self.begin_track()
+        pending = self.pending
+        if pending.n:
+            data, self.last_tick, self.prev_status = self._encode(pending, 0, None)
+            self._emit(data)
+            self.pending = EventStore(1024)
+
+    # Write one complete, already encoded track
+    def write_track(self, midi_bytes):
+        self.begin_track()
+        self._emit(midi_bytes)
+        self.end_track()
+
+    def end_track(self):
+        self.flush()
+        if self.seekable:
+            end = self.fileobj.tell()
+            self.fileobj.seek(self.length_pos)
+            self.fileobj.write(self.length.to_bytes(4, 'big'))
+            self.fileobj.seek(end)
+        else:
+            self._write(b"MTrk" + self.length.to_bytes(4, 'big'))
+            self.spool.seek(0)
+            shutil.copyfileobj(self.spool, self.fileobj)
+            self.bytes_written += self.length
+            self.spool.close()
+            self.spool = None
+        self.track_open = False
+        self.tracks_written += 1
+
+    # Ends the open track. A file without any track gets one holding just End of Track, so
+    # that it still has the MTrk chunk its header announces.
+    def close(self):
+        if not self.track_open and not self.tracks_written and self.ntracks:
+            self.write_meta(0, META_END_OF_TRACK)
+        if self.track_open:
+            self.end_track()
+        if self.profiler is not None:
+            self.profiler.count("bytes.file", self.bytes_written)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Reading. A track is decoded in three steps:
+#  1. For every byte position p, work out (with array operations) where the next event would
+#     start if one started at p: skip the delta VLQ, then the status/data bytes or the
+#     meta/sysex length + payload. Running-status events depend on the data length of the
+#     running status (1 or 2 bytes), so there is one table per length.
+#  2. Follow that chain from position 0. This is the only per-event Python work: two list
+#     lookups per event.
+#  3. Gather deltas, statuses (running status forward-filled), data bytes and payloads at the
+#     event starts, again with array operations.
+# Malformed tracks (VLQs longer than VLQ_MAX_BYTES, payloads past the end of the track, events
+# cut off by it) raise ValueError.
+
+VLQ_MAX_BYTES = 4  # the SMF limit (values up to 0x0FFFFFFF)
+
+# Value of the VLQ starting at each of `starts`; `term` maps positions to the VLQ's last byte.
+# Only the first VLQ_MAX_BYTES bytes are read, so junk cannot overflow; see _check_vlqs.
+def _vlq_values(data, starts, term):
+    lengths = np.minimum(term[starts] - starts + 1, VLQ_MAX_BYTES)
+    values = np.zeros(len(starts), dtype=np.int64)
+    for k in range(int(lengths.max()) if len(starts) else 0):
+        m = lengths > k
+        values[m] = (values[m] << 7) | (data[starts[m] + k] & 0x7F)
+    return values
+
+def _check_vlqs(starts, term, what):
+    if len(starts) and int((term[starts] - starts).max()) >= VLQ_MAX_BYTES:
+        raise ValueError("%s VLQ longer than %d bytes" % (what, VLQ_MAX_BYTES))
+
+def decode_track(track):
+    size = len(track)
+    if not size:
+        return EventStore(1), False
+    # padded so that lookahead past the end never goes out of bounds
+    data = np.zeros(size + 16, dtype=np.uint8)
+    data[:size] = np.frombuffer(track, dtype=np.uint8)
+    pos = np.arange(len(data), dtype=np.int64)
+    # term[p]: first position >= p holding a byte < 0x80 (last byte of a VLQ starting at p)
+    term = np.minimum.accumulate(np.where(data < 0x80, pos, len(data) - 1)[::-1])[::-1]
+    # Step 1, for all positions p < size
+    p = pos[:size]
+    q = np.minimum(term[p] + 1, len(data) - 3)  # status (or first data byte) position
+    s = data[q].astype(np.int64)
+    explicit_len = DATA_LEN[s >> 4]
+    next_explicit = q + 1 + explicit_len
+    special = (s == META) | (s == SYSEX) | (s == SYSEX_ESCAPE)
+    sp = np.flatnonzero(special)
+    len_pos = q[sp] + np.where(s[sp] == META, 2, 1)
+    len_pos = np.minimum(len_pos, len(data) - 1)
+    next_explicit[sp] = term[len_pos] + 1 + _vlq_values(data, len_pos, term)
+    # Chain over states 2 * position + (running status data length - 1): an explicit channel
+    # status sets the length, meta/sysex events keep it, running-status events use it
+    running = s < 0x80
+    new_len = np.where(~running & ~special & (s < 0xF0), explicit_len, 0)
+    chain = np.empty(2 * size, dtype=np.int64)
+    for run_len in (1, 2):
+        after = np.where(new_len > 0, new_len, run_len)
+        chain[run_len - 1::2] = 2 * np.where(running, q + run_len, next_explicit) + after - 1
+    np.minimum(chain, 2 * size + 2, out=chain)  # past the end: stops the walk below
+    chain = memoryview(chain)  # indexing a memoryview yields ints without a list copy
+    # Step 2
+    starts = []
+    append = starts.append
+    i, end = 1, 2 * size
+    while 0 <= i < end:
+        append(i)
+        i = chain[i]
+    if i >> 1 != size:
+        raise ValueError("track data ends in the middle of an event")
+    # Step 3
+    starts = np.array(starts, dtype=np.int64) >> 1
+    _check_vlqs(starts, term, "delta time")
+    n = len(starts)
+    ticks = np.cumsum(_vlq_values(data, starts, term))
+    q = term[starts] + 1
+    s = data[q]
+    explicit = s >= 0x80
+    is_channel = explicit & (s < 0xF0)
+    last = np.maximum.accumulate(np.where(is_channel, np.arange(n), -1))
+    if (~explicit & (last < 0)).any():
+        raise ValueError("running status without a preceding channel message")
+    status = np.where(explicit, s, s[np.maximum(last, 0)]).astype(np.uint8)
+    d = np.where(explicit, q + 1, q)
+    store = EventStore(n)
+    store.n = n
+    store.tick[:n] = ticks
+    store.status[:n] = status
+    store.data1[:n] = np.where(status < 0xF0, data[d], 0)
+    store.data2[:n] = np.where((status < 0xF0) & (DATA_LEN[status >> 4] == 2), data[d + 1], 0)
+    store.ext[:n] = -1
+    store.priority[:n] = np.where(((status & 0xF0) == 0x90) & (store.data2[:n] == 0),
+                                  PRIORITY_NOTE_OFF, _CHANNEL_PRIORITY[status >> 4])
+    # Meta and sysex payloads
+    sp = np.flatnonzero(status >= 0xF0)
+    if len(sp):
+        is_meta = status[sp] == META
+        store.data1[sp] = np.where(is_meta, data[q[sp] + 1], 0)
+        store.priority[sp] = np.where(is_meta & (store.data1[sp] == META_END_OF_TRACK),
+                                      PRIORITY_LAST, PRIORITY_META)
+        len_pos = q[sp] + np.where(is_meta, 2, 1)
+        _check_vlqs(len_pos, term, "payload length")
+        pay_len = _vlq_values(data, len_pos, term)
+        pay_start = term[len_pos] + 1
+        if (pay_start + pay_len > size).any():
+            raise ValueError("meta/sysex payload runs past the end of the track")
+        total = int(pay_len.sum())
+        within = np.arange(total) - np.repeat(np.cumsum(pay_len) - pay_len, pay_len)
+        store.payload = bytearray(data[np.repeat(pay_start, pay_len) + within].tobytes())
+        store.payload_offsets = [0] + np.cumsum(pay_len).tolist()
+        store.ext[sp] = np.arange(len(sp), dtype=np.int32)
+    return store, bool((~explicit).any())
+
+# A parsed Standard MIDI File: format, time division and one EventStore per track (events in
+# file order). running_status records per track whether the file used running status, so
+# write() reproduces files made by SMFWriter byte for byte.
+class MidiFile:
+    def __init__(self, fmt, division, tracks, running_status):
+        self.fmt = fmt
+        self.division = division
+        self.tracks = tracks
+        self.running_status = running_status
+
+    @property
+    def ticks_per_beat(self):
+        if self.division & 0x8000:
+            raise ValueError("file uses SMPTE time division, not ticks per beat")
+        return self.division
+
+    def write(self, fileobj):
+        with SMFWriter(fileobj, self.division, self.fmt, len(self.tracks)) as writer:
+            for track, running_status in zip(self.tracks, self.running_status):
+                writer.running_status = running_status
+                writer.write_store(track)
+                writer.end_track()
+        return writer.bytes_written
+
+# Parse a .mid file (path, or bytes-like data). Files are memory-mapped rather than read.
+def read_smf(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return _parse_smf(memoryview(source))
+    with open(source, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("%s is empty" % source)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                return _parse_smf(view)
+            finally:
+                view.release()
+
+def _parse_smf(view):
+    if bytes(view[:4]) != b"MThd":
+        raise ValueError("not a Standard MIDI File (missing MThd)")
+    header_len = int.from_bytes(view[4:8], 'big')
+    fmt = int.from_bytes(view[8:10], 'big')
+    ntracks = int.from_bytes(view[10:12], 'big')
+    division = int.from_bytes(view[12:14], 'big')
+    pos = 8 + header_len
+    tracks, running_status = [], []
+    while pos + 8 <= len(view) and len(tracks) < ntracks:
+        chunk_type = bytes(view[pos:pos + 4])
+        length = int.from_bytes(view[pos + 4:pos + 8], 'big')
+        body = view[pos + 8:pos + 8 + length]
+        if len(body) != length:
+            raise ValueError("truncated %r chunk" % chunk_type)
+        if chunk_type == b"MTrk":  # unknown chunk types are skipped, as the spec asks
+            store, used_running_status = decode_track(body)
+            tracks.append(store)
+            running_status.append(used_running_status)
+        pos += 8 + length
+    return MidiFile(fmt, division, tracks, running_status)
@@ -0,0 +1,125 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from eternaldisco import (CHAN_BASS, CHAN_CLASSICAL, CHAN_DRUMS, CHAN_REGGAE, CHAN_ROCK,
+                          build_song)
+from smf import TempoMap
+from synth import SAMPLE_RATE, DrumCache, render_length, render_store, write_wav
+
+# Stem rendering: every channel is rendered by its own worker process straight into one row
+# of a float32 (stems + 1) x frames array in shared memory. The last row is the mix bus,
+# which the workers then fill frame range by frame range (the sum over the stem rows), so no
+# samples are copied between processes. The stems and the mix are written as WAV files.
+
+STEM_NAMES = {
+    CHAN_CLASSICAL: "strings",
+    CHAN_REGGAE:    "organ",
+    CHAN_BASS:      "bass",
+    CHAN_ROCK:      "guitar",
+    CHAN_DRUMS:     "drums",
+}
+
+# The shared array, attached to the segment `name`
+def _attach(name, shape):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+
+# Runs in the worker process: render one channel into its stem row
+def _render_stem_job(job):
+    name, shape, row, store, ticks_per_beat, sample_rate, drum_cache = job
+    start = time.perf_counter()
+    shm, stems = _attach(name, shape)
+    try:
+        render_store(store, ticks_per_beat, sample_rate, out=stems[row],
+                     drums=DrumCache(sample_rate, drum_cache))
+    finally:
+        del stems
+        shm.close()
+    return time.perf_counter() - start
+
+# Runs in the worker process: mix frames [start:stop) of all stems into the mix row
+def _mix_job(job):
+    name, shape, start, stop = job
+    shm, stems = _attach(name, shape)
+    try:
+        np.sum(stems[:-1, start:stop], axis=0, out=stems[-1, start:stop])
+    finally:
+        del stems
+        shm.close()
+
+# The events of one channel, plus the meta events (tempo map) every stem needs
+def channel_store(store, channel):
+    status = store.status[:store.n]
+    return store.subset((status >= 0xF0) | ((status & 0x0F) == channel))
+
+# Render every channel of a spec to out_dir/stem_<channel>_<name>.wav and the mix to
+# out_dir/mix.wav, on `workers` processes (None: one per CPU, at most one per stem).
+# drum_cache: directory the workers share their drum one-shots through (see synth.DrumCache).
+# Returns a report with the file paths, per-stem render times and the wall time.
+def render_stems(spec, out_dir, sample_rate=SAMPLE_RATE, workers=None, drum_cache=None):
+    os.makedirs(out_dir, exist_ok=True)
+    wall = time.perf_counter()
+    song = build_song(spec)
+    song.events.sort()
+    store, tpb = song.events, song.ticks_per_beat
+    status = store.status[:store.n]
+    channels = sorted(set((status[status < 0xF0] & 0x0F).tolist()))
+    frames = render_length(store, tpb, sample_rate, TempoMap.from_store(store, tpb))
+    shape = (len(channels) + 1, frames)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * 4, 1))
+    try:
+        stems = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        stems[:] = 0
+        jobs = [(shm.name, shape, row, channel_store(store, channel), tpb, sample_rate, drum_cache)
+                for row, channel in enumerate(channels)]
+        step = -(-frames // len(channels))
+        mix_jobs = [(shm.name, shape, start, min(start + step, frames))
+                    for start in range(0, frames, step)]
+        workers = min(workers or os.cpu_count() or 1, len(jobs))
+        if workers == 1:
+            seconds = [_render_stem_job(job) for job in jobs]
+            for job in mix_jobs:
+                _mix_job(job)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                seconds = list(pool.map(_render_stem_job, jobs))
+                list(pool.map(_mix_job, mix_jobs))
+        paths = []
+        for row, channel in enumerate(channels):
+            path = os.path.join(out_dir, "stem_%d_%s.wav" % (channel, STEM_NAMES.get(channel, "channel")))
+            write_wav(path, stems[row], sample_rate)
+            paths.append(path)
+        paths.append(os.path.join(out_dir, "mix.wav"))
+        write_wav(paths[-1], stems[-1], sample_rate)
+        del stems
+    finally:
+        shm.close()
+        shm.unlink()
+    return {
+        "paths": paths,
+        "stem_seconds": dict(zip(channels, seconds)),
+        "audio_seconds": frames / sample_rate,
+        "wall_seconds": time.perf_counter() - wall,
+    }
+
+if __name__ == "__main__":
+    import json
+
+    from eternaldisco import default_spec
+
+    parser = argparse.ArgumentParser(description="Render one WAV stem per channel plus the mix.")
+    parser.add_argument("out_dir")
+    parser.add_argument("--rate", type=int, default=SAMPLE_RATE)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=1, help="play every progression this many times")
+    parser.add_argument("--drum-cache", help="directory to keep the drum one-shots in")
+    args = parser.parse_args()
+    spec = default_spec()
+    for section, progression in spec["progressions"].items():
+        spec["progressions"][section] = progression * args.repeat
+    print(json.dumps(render_stems(spec, args.out_dir, args.rate, args.workers, args.drum_cache), indent=2))
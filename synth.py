@@ -0,0 +1,411 @@
+import argparse
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+from eternaldisco import (CHAN_DRUMS, CRASH_CYMBAL, HIHAT_CLOSED, HIHAT_OPEN, KICK,
+                          PROG_BASS, PROG_GUITAR, PROG_ORGAN, PROG_STRINGS, RIDE_CYMBAL,
+                          SNARE, TOM_LOW, build_song)
+from smf import TempoMap
+
+# Offline audio rendering: the sorted event store is turned into notes (note-on/note-off
+# pairs, drum hits on channel 9), and every note is synthesized as one vector operation over
+# all of its samples and added into the output. Pitched notes come from a small additive
+# oscillator bank per GM program: the partials below Nyquist are summed into a one-cycle
+# wavetable, which is then read at the note's phase (one interpolated lookup per sample
+# instead of one sine per partial), and shaped by an ADSR envelope. Drum hits are synthesized
+# from a swept sine and filtered noise. Output is mono float32 in [-1, 1], written as 16-bit
+# PCM WAV.
+
+SAMPLE_RATE = 44100
+TABLE_SIZE = 4096   # wavetable samples per cycle
+MASTER_GAIN = 0.25  # per-voice level at full velocity; keeps the default mix below clipping
+
+# Timbre per GM program:
+#   harmonics/amps: partials of the oscillator bank (multiples of the note frequency,
+#                   ascending)
+#   detune:         second bank detuned by this frequency factor (chorus), 0 for none
+#   attack/decay/release in seconds, sustain level 0..1 (0: plucked, decays to silence)
+#   drive:          tanh saturation amount (0 for none)
+#   gain:           level relative to MASTER_GAIN
+TIMBRES = {
+    PROG_STRINGS: {"harmonics": [1, 2, 3, 4, 5], "amps": [1.0, 0.5, 0.33, 0.25, 0.2],
+                   "detune": 1.004, "attack": 0.12, "decay": 0.3, "sustain": 0.8,
+                   "release": 0.3, "drive": 0, "gain": 1.0},
+    PROG_ORGAN:   {"harmonics": [0.5, 1, 2, 3, 4], "amps": [0.6, 1.0, 0.7, 0.4, 0.3],
+                   "detune": 0, "attack": 0.005, "decay": 0.05, "sustain": 0.9,
+                   "release": 0.03, "drive": 0, "gain": 1.0},
+    PROG_BASS:    {"harmonics": [1, 2, 3], "amps": [1.0, 0.4, 0.15],
+                   "detune": 0, "attack": 0.004, "decay": 0.5, "sustain": 0.3,
+                   "release": 0.06, "drive": 0, "gain": 1.5},
+    PROG_GUITAR:  {"harmonics": [1, 2, 3, 4, 5, 6], "amps": [1.0, 0.5, 0.33, 0.25, 0.2, 0.16],
+                   "detune": 1.006, "attack": 0.003, "decay": 0.8, "sustain": 0.6,
+                   "release": 0.08, "drive": 4.0, "gain": 0.35},
+}
+DEFAULT_TIMBRE = {"harmonics": [1, 2], "amps": [1.0, 0.3], "detune": 0, "attack": 0.01,
+                  "decay": 0.2, "sustain": 0.7, "release": 0.1, "drive": 0, "gain": 1.0}
+
+# Drum sounds by GM percussion note:
+#   tone:   (start Hz, end Hz, sweep seconds, level, decay seconds) of a pitch-swept sine
+#   noise:  (level, decay seconds) of white noise
+#   bright: noise high-pass strength (first differences, 0..1; cymbals and hats)
+DRUMS = {
+    KICK:         {"tone": (150, 45, 0.06, 1.0, 0.15), "noise": (0.08, 0.01), "bright": 0.0},
+    SNARE:        {"tone": (220, 180, 0.02, 0.5, 0.08), "noise": (0.8, 0.12), "bright": 0.3},
+    HIHAT_CLOSED: {"tone": None, "noise": (0.5, 0.035), "bright": 1.0},
+    HIHAT_OPEN:   {"tone": None, "noise": (0.5, 0.25), "bright": 1.0},
+    RIDE_CYMBAL:  {"tone": (3100, 3000, 0.1, 0.1, 0.6), "noise": (0.35, 0.7), "bright": 1.0},
+    CRASH_CYMBAL: {"tone": None, "noise": (0.7, 1.2), "bright": 0.8},
+    TOM_LOW:      {"tone": (110, 80, 0.1, 1.0, 0.3), "noise": (0.1, 0.05), "bright": 0.0},
+}
+DEFAULT_DRUM = {"tone": (400, 300, 0.02, 0.5, 0.1), "noise": (0.3, 0.1), "bright": 0.5}
+DRUM_TAIL = 6  # drum sounds last this many of their longest decay times
+DRUM_GAIN = 0.6  # drum kit level relative to MASTER_GAIN
+VELOCITY_LAYERS = (31, 63, 95, 127)  # top velocity of each drum velocity layer
+
+def note_frequency(pitch):
+    return 440.0 * 2.0 ** ((np.asarray(pitch, dtype=np.float64) - 69) / 12)
+
+# Notes of a sorted event store, as arrays of equal length:
+#   channel, pitch, velocity, start and end (ticks)
+# The k-th note-on of a channel and pitch is paired with its k-th note-off; notes that are
+# never released end with the last event. Channel 9 note-ons are drum hits (start = end).
+def song_notes(store):
+    ticks, status, data1, data2 = store.columns()
+    kind = status & 0xF0
+    channel = (status & 0x0F).astype(np.int64)
+    on = (kind == 0x90) & (data2 > 0)
+    off = ((kind == 0x80) | ((kind == 0x90) & (data2 == 0))) & (channel != CHAN_DRUMS)
+    # (channel, pitch) groups, time order kept within a group (the store is sorted)
+    pitch_key = channel << 7 | data1
+    on_idx = np.flatnonzero(on)
+    on_idx = on_idx[np.argsort(pitch_key[on_idx], kind="stable")]
+    off_idx = np.flatnonzero(off)
+    off_idx = off_idx[np.argsort(pitch_key[off_idx], kind="stable")]
+    # Pair by (group, rank within the group)
+    on_pair, off_pair = (_group_rank_keys(pitch_key[idx]) for idx in (on_idx, off_idx))
+    pos = np.searchsorted(off_pair, on_pair)
+    found = pos < len(off_pair)
+    found[found] = off_pair[pos[found]] == on_pair[found]
+    end_tick = ticks[store.n - 1] if store.n else 0
+    end = np.full(len(on_idx), end_tick, dtype=np.int64)
+    end[found] = ticks[off_idx[pos[found]]]
+    drums = channel[on_idx] == CHAN_DRUMS
+    end[drums] = ticks[on_idx[drums]]
+    order = np.argsort(ticks[on_idx], kind="stable")
+    return {
+        "channel": channel[on_idx][order],
+        "pitch": data1[on_idx][order].astype(np.int64),
+        "velocity": data2[on_idx][order].astype(np.int64),
+        "start": ticks[on_idx][order],
+        "end": end[order],
+    }
+
+# group << 32 | rank of each element within its run of equal (sorted) group keys
+def _group_rank_keys(keys):
+    rank = np.arange(len(keys)) - np.searchsorted(keys, keys, side="left")
+    return keys << 32 | rank
+
+# Program per channel from the store's program changes (the last one wins)
+def channel_programs(store):
+    _, status, data1, _ = store.columns()
+    programs = {}
+    for i in np.flatnonzero((status & 0xF0) == 0xC0).tolist():
+        programs[int(status[i] & 0x0F)] = int(data1[i])
+    return programs
+
+# Attack/decay/sustain level at t seconds after note-on (arrays broadcast)
+def adsr(t, attack, decay, sustain):
+    return np.where(t < attack, t / attack, sustain + (1 - sustain) * np.exp(-(t - attack) / decay))
+
+# Release factor t seconds after note-off: a linear fade to silence
+def release_ramp(t, release):
+    return np.clip(1 - t / release, 0, 1)
+
+# ADSR envelope over n samples for a note held for `held` samples
+def envelope(timbre, n, held, sample_rate):
+    t = np.arange(n, dtype=np.float32) / sample_rate
+    env = adsr(t, timbre["attack"], timbre["decay"], timbre["sustain"]).astype(np.float32)
+    if held < n:
+        env[held:] = env[held] * release_ramp(t[held:] - t[held], timbre["release"])
+    return env
+
+# Samples of one pitched note: oscillator bank, envelope, optional saturation
+def synth_note(timbre, pitch, velocity, duration, sample_rate):
+    held = max(int(duration * sample_rate), 1)
+    n = held + int(timbre["release"] * sample_rate)
+    freq = float(note_frequency(pitch))
+    table = wavetable(timbre, freq, sample_rate)
+    cycles = (freq / sample_rate) * np.arange(n)
+    wave_ = read_table(table, cycles)
+    if timbre["detune"]:
+        wave_ += read_table(table, cycles * timbre["detune"])
+        wave_ *= 0.5
+    wave_ *= envelope(timbre, n, held, sample_rate)
+    if timbre["drive"]:
+        wave_ = np.tanh(timbre["drive"] * wave_) / np.tanh(timbre["drive"])
+    return wave_ * (MASTER_GAIN * timbre["gain"] * velocity / 127)
+
+# Number of a timbre's partials (in ascending order) that stay below Nyquist at `freq`
+def audible_partials(timbre, freq, sample_rate):
+    top = sample_rate / 2 / (freq * max(timbre["detune"], 1))
+    return max(int(np.searchsorted(timbre["harmonics"], top, side="left")), 1)
+
+# Two fundamental cycles (so sub-harmonics such as 0.5 are periodic) of the first `count`
+# partials of a timbre, normalized to the sum of their amplitudes. The table has one extra
+# sample (= the first) for interpolation. Tables are built once per set of partials and
+# shared (read-only) by every note and renderer that uses them.
+_partial_tables = {}
+
+def partial_table(timbre, count):
+    key = (tuple(timbre["harmonics"][:count]), tuple(timbre["amps"][:count]))
+    table = _partial_tables.get(key)
+    if table is None:
+        harmonics = np.asarray(key[0], dtype=np.float64)
+        amps = np.asarray(key[1], dtype=np.float64)
+        x = np.arange(2 * TABLE_SIZE + 1) / TABLE_SIZE
+        table = (amps @ np.sin(2 * np.pi * np.outer(harmonics, x)) / amps.sum()).astype(np.float32)
+        table.flags.writeable = False
+        _partial_tables[key] = table
+    return table
+
+# Wavetable of a timbre at `freq` (the partials below Nyquist)
+def wavetable(timbre, freq, sample_rate):
+    return partial_table(timbre, audible_partials(timbre, freq, sample_rate))
+
+# Linearly interpolated table lookup at phases given in cycles
+def read_table(table, cycles):
+    pos = (cycles * TABLE_SIZE) % (2 * TABLE_SIZE)
+    i = pos.astype(np.int64)
+    frac = (pos - i).astype(np.float32)
+    lo = table[i]
+    return lo + frac * (table[i + 1] - lo)
+
+# Length of a drum sound in seconds
+def drum_seconds(drum):
+    return DRUM_TAIL * max(drum["noise"][1], drum["tone"][4] if drum["tone"] else 0)
+
+# Longest time any sound rings on after its note-off (or drum hit)
+def max_tail():
+    return max([timbre["release"] for timbre in list(TIMBRES.values()) + [DEFAULT_TIMBRE]] +
+               [drum_seconds(drum) for drum in list(DRUMS.values()) + [DEFAULT_DRUM]])
+
+# Samples of one drum hit
+def drum_hit(note, velocity, sample_rate):
+    drum = DRUMS.get(note, DEFAULT_DRUM)
+    n = int(drum_seconds(drum) * sample_rate)
+    t = np.arange(n, dtype=np.float32) / sample_rate
+    level, decay = drum["noise"]
+    noise = np.random.default_rng(note).standard_normal(n).astype(np.float32)
+    if drum["bright"]:
+        noise[1:] -= drum["bright"] * noise[:-1]
+    out = level * noise * np.exp(-t / decay)
+    if drum["tone"]:
+        f0, f1, sweep, level, decay = drum["tone"]
+        # exponential sweep from f0 to f1, then constant f1; phase = integral of frequency
+        k = np.log(f1 / f0) / sweep
+        phase = np.where(t < sweep, f0 * np.expm1(k * t) / k,
+                         f0 * np.expm1(k * sweep) / k + f1 * (t - sweep))
+        out += level * np.sin(2 * np.pi * phase) * np.exp(-t / decay)
+    return out * (MASTER_GAIN * DRUM_GAIN * velocity / 127)
+
+# Drum one-shots, synthesized once per sample rate, note and velocity layer. A layer's sound
+# is rendered at the layer's top velocity; a hit plays it scaled to the hit's velocity (the
+# drum synthesis is linear in velocity, so this is exact). With a directory, the one-shots
+# are also kept on disk as .npy files, named after the drum's parameters so that edits to
+# DRUMS invalidate them, written atomically and loaded memory-mapped.
+class DrumCache:
+    def __init__(self, sample_rate=SAMPLE_RATE, directory=None):
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.shots = {}   # (note, layer) -> float32 one-shot
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    # One-shot and scale factor for a hit
+    def get(self, note, velocity):
+        layer = min(np.searchsorted(VELOCITY_LAYERS, velocity), len(VELOCITY_LAYERS) - 1)
+        top = VELOCITY_LAYERS[layer]
+        shot = self.shots.get((note, layer))
+        if shot is None:
+            shot = self.shots[note, layer] = self._load(note, top)
+        return shot, velocity / top
+
+    # Add a hit at sample `start` into `out`
+    def add_hit(self, out, start, note, velocity):
+        shot, scale = self.get(note, velocity)
+        n = min(len(shot), len(out) - start)
+        if n > 0:
+            out[start:start + n] += np.float32(scale) * shot[:n]
+
+    def path(self, note, velocity):
+        params = [DRUMS.get(note, DEFAULT_DRUM), DRUM_TAIL, DRUM_GAIN, MASTER_GAIN]
+        digest = hashlib.sha256(json.dumps(params).encode("ascii")).hexdigest()[:16]
+        return os.path.join(self.directory, "drum_%d_%d_%d_%s.npy"
+                            % (self.sample_rate, note, velocity, digest))
+
+    def _load(self, note, velocity):
+        if self.directory is None:
+            return drum_hit(note, velocity, self.sample_rate)
+        path = self.path(note, velocity)
+        try:
+            return np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            pass
+        shot = drum_hit(note, velocity, self.sample_rate)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-", suffix=".npy")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, shot)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return np.load(path, mmap_mode="r")
+
+# Number of samples render_store() produces for a sorted event store
+def render_length(store, ticks_per_beat, sample_rate=SAMPLE_RATE, tempo_map=None):
+    if tempo_map is None:
+        tempo_map = TempoMap.from_store(store, ticks_per_beat)
+    song_end = tempo_map.tick_to_seconds(int(store.tick[store.n - 1])) if store.n else 0.0
+    return int((song_end + max_tail()) * sample_rate) + 1
+
+# Render a sorted event store to mono float32 samples. With `out` (a zeroed float32 array of
+# render_length() samples, e.g. in shared memory) the samples are mixed into it in place.
+# drums: a DrumCache to take the drum one-shots from (default: a new in-memory one).
+def render_store(store, ticks_per_beat, sample_rate=SAMPLE_RATE, tempo_map=None, out=None,
+                 drums=None):
+    if tempo_map is None:
+        tempo_map = TempoMap.from_store(store, ticks_per_beat)
+    notes = song_notes(store)
+    programs = channel_programs(store)
+    start = np.rint(tempo_map.tick_to_seconds(notes["start"]) * sample_rate).astype(np.int64)
+    duration = tempo_map.tick_to_seconds(notes["end"]) - tempo_map.tick_to_seconds(notes["start"])
+    if out is None:
+        out = np.zeros(render_length(store, ticks_per_beat, sample_rate, tempo_map), dtype=np.float32)
+    if drums is None:
+        drums = DrumCache(sample_rate)
+    for i in range(len(start)):
+        channel, pitch, velocity = int(notes["channel"][i]), int(notes["pitch"][i]), int(notes["velocity"][i])
+        s = start[i]
+        if channel == CHAN_DRUMS:
+            drums.add_hit(out, s, pitch, velocity)
+            continue
+        timbre = TIMBRES.get(programs.get(channel, 0), DEFAULT_TIMBRE)
+        samples = synth_note(timbre, pitch, velocity, duration[i], sample_rate)
+        out[s:s + len(samples)] += samples[:len(out) - s]
+    return out
+
+# Render a song spec to mono float32 samples
+def render_audio(spec=None, sample_rate=SAMPLE_RATE, drums=None):
+    song = build_song(spec)
+    song.events.sort()
+    return render_store(song.events, song.ticks_per_beat, sample_rate, drums=drums)
+
+# Float samples in [-1, 1] as 16-bit PCM (clipped)
+def to_pcm16(samples):
+    return (np.clip(samples, -1, 1) * 32767).astype("<i2")
+
+# Mono 16-bit WAV file (path or binary file object)
+def write_wav(path, samples, sample_rate=SAMPLE_RATE):
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(to_pcm16(samples).tobytes())
+
+# Mono 16-bit WAV file written through a memory map, for renders too long to hold in memory.
+# The file is preallocated to `frames` samples (or grown `window` samples at a time if the
+# length is not known) and blocks are converted to PCM straight into a mapped window of the
+# data chunk; only one window is mapped at a time, so memory stays bounded however long the
+# render runs. close() trims the file to the samples written and fills in the RIFF sizes.
+class MappedWav:
+    HEADER = 44
+    MAX_FRAMES = (0xFFFFFFFF - 36) // 2   # RIFF sizes are 32 bits
+
+    def __init__(self, path, sample_rate=SAMPLE_RATE, frames=None, window=1 << 22):
+        if frames is not None and frames > self.MAX_FRAMES:
+            raise ValueError("%d frames do not fit in a WAV file" % frames)
+        self.sample_rate = sample_rate
+        self.window = window
+        self.frames = 0          # samples written
+        self.file = open(path, "wb+")
+        self.file.write(self._header(0))
+        self.file.truncate(self.HEADER + 2 * (frames or 0))
+        self.map = None
+        self.map_start = 0
+        self.scratch = np.zeros(0, dtype=np.float32)
+
+    def _header(self, frames):
+        return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + 2 * frames, b"WAVE",
+                           b"fmt ", 16, 1, 1, self.sample_rate, 2 * self.sample_rate, 2, 16,
+                           b"data", 2 * frames)
+
+    # Map the window starting at sample `start`, growing the file if it ends short of it
+    def _map(self, start):
+        self._unmap()
+        end = min(start + self.window, self.MAX_FRAMES)
+        if end <= start:
+            raise ValueError("WAV file is full (%d frames)" % self.MAX_FRAMES)
+        size = self.HEADER + 2 * end
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() < size:
+            self.file.truncate(size)
+        self.map = np.memmap(self.file, dtype="<i2", mode="r+", offset=self.HEADER + 2 * start,
+                             shape=(end - start,))
+        self.map_start = start
+
+    def _unmap(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map = None   # the last reference: unmaps the window
+
+    # Append float samples in [-1, 1] (clipped), as to_pcm16()
+    def write(self, samples):
+        if len(self.scratch) < len(samples):
+            self.scratch = np.empty(len(samples), dtype=np.float32)
+        pos = 0
+        while pos < len(samples):
+            if self.map is None or self.frames >= self.map_start + len(self.map):
+                self._map(self.frames)
+            i = self.frames - self.map_start
+            n = min(len(samples) - pos, len(self.map) - i)
+            clipped = np.clip(samples[pos:pos + n], -1, 1, out=self.scratch[:n])
+            np.multiply(clipped, 32767, out=self.map[i:i + n], casting="unsafe")
+            self.frames += n
+            pos += n
+
+    def close(self):
+        if self.file.closed:
+            return
+        self._unmap()
+        self.file.truncate(self.HEADER + 2 * self.frames)
+        self.file.seek(0)
+        self.file.write(self._header(self.frames))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the song to a WAV file.")
+    parser.add_argument("out", nargs="?", default="genre_blend.wav")
+    parser.add_argument("--rate", type=int, default=SAMPLE_RATE)
+    parser.add_argument("--drum-cache", help="directory to keep the drum one-shots in")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    samples = render_audio(sample_rate=args.rate, drums=DrumCache(args.rate, args.drum_cache))
+    elapsed = time.perf_counter() - start
+    write_wav(args.out, samples, args.rate)
+    seconds = len(samples) / args.rate
+    print("%s: %.1f s of audio rendered in %.2f s (%.0fx real time)"
+          % (args.out, seconds, elapsed, seconds / elapsed))